@@ -0,0 +1,307 @@
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import ctypes
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import pygame
+from PIL import Image
+
+import slide
+
+#region Constants
+DEFAULT_SIZES = "4000x3000,1920x1440,1366x768"
+DEFAULT_COUNT = 12
+DEFAULT_TRANSITIONS = 3
+STAGE_ORDER = ("slide", "flip_out_current", "flip_in_new", "crossfade", "scale_up")
+M_MMAP_THRESHOLD = -3 # glibc mallopt parameter
+MMAP_THRESHOLD_BYTES = 128 * 1024
+# Warm frames may touch a few new pages for Python objects, a window-sized pixel buffer is hundreds of pages
+WARM_FRAME_PAGE_FAULTS = 32
+#endregion Constants
+
+#region Corpus
+def parse_sizes(sizes):
+    parsed = []
+    for size in sizes.split(","):
+        width, height = size.lower().split("x")
+        parsed.append((int(width), int(height)))
+    return parsed
+
+def generate_corpus(folder_url, sizes, count, seed):
+    """Writes count synthetic JPEGs, cycling through sizes, with enough noise to make decoding realistic."""
+    rng = random.Random(seed)
+    for idx in range(count):
+        width, height = sizes[idx % len(sizes)]
+        color_a = tuple(rng.randint(0, 255) for _ in range(3))
+        color_b = tuple(rng.randint(0, 255) for _ in range(3))
+        gradient = Image.linear_gradient("L").resize((width, height))
+        base = Image.composite(Image.new("RGB", (width, height), color_a), Image.new("RGB", (width, height), color_b), gradient)
+        noise = Image.effect_noise((width, height), 40).convert("RGB")
+        image = Image.blend(base, noise, 0.25)
+        sub_folder = os.path.join(folder_url, "set" + str(idx % 3))
+        os.makedirs(sub_folder, exist_ok=True)
+        image.save(os.path.join(sub_folder, "photo" + str(idx) + ".jpg"), quality=90)
+
+def image_size(image_url):
+    with Image.open(image_url) as img:
+        return img.size
+#endregion Corpus
+
+#region Stats
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def summarize(samples):
+    return {
+        "frames": len(samples),
+        "mean_ms": sum(samples) / len(samples) if samples else 0.0,
+        "p50_ms": percentile(samples, 0.50),
+        "p95_ms": percentile(samples, 0.95),
+        "p99_ms": percentile(samples, 0.99),
+        "max_ms": max(samples) if samples else 0.0,
+    }
+#endregion Stats
+
+#region Benchmarks
+def bench_resize(source_folder, destination_folder, workers):
+    image_count = sum(1 for root, dirs, files in os.walk(source_folder) for file in files if slide.is_image_file(file))
+
+    # The first finished thumbnail is when a progressive startup can put a slide on screen
+    ready_times = []
+    start = time.perf_counter()
+    slide.resize_all_images(source_folder, destination_folder, slide.WINDOW_WIDTH, slide.WINDOW_HEIGHT, workers=workers,
+                            on_image_ready=lambda thumbnail_url, entry: ready_times.append(time.perf_counter() - start))
+    cold_seconds = time.perf_counter() - start
+    # The pool's workers have been reaped by now, so this is the largest of them
+    worker_peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024 if resource else 0.0
+
+    start = time.perf_counter()
+    slide.resize_all_images(source_folder, destination_folder, slide.WINDOW_WIDTH, slide.WINDOW_HEIGHT, workers=workers)
+    warm_seconds = time.perf_counter() - start
+
+    return {
+        "images": image_count,
+        "cold_seconds": cold_seconds,
+        "cold_images_per_second": image_count / cold_seconds if cold_seconds else 0.0,
+        "first_image_ms": min(ready_times) * 1000 if ready_times else 0.0,
+        "first_frame_target_ms": slide.FIRST_FRAME_TARGET_MS,
+        "warm_seconds": warm_seconds,
+        "worker_peak_rss_mb": worker_peak_rss_mb,
+    }
+
+def pin_mmap_threshold():
+    """Makes glibc serve every large allocation with a fresh mmap, so each one shows up as page faults.
+
+    glibc otherwise raises its mmap threshold after the first large free and recycles the memory,
+    and a pixel buffer allocated and freed inside SDL every frame would go unnoticed. Returns
+    False where this is not glibc.
+    """
+    try:
+        return bool(ctypes.CDLL(None).mallopt(M_MMAP_THRESHOLD, MMAP_THRESHOLD_BYTES))
+    except (OSError, AttributeError):
+        return False
+
+def count_page_faults():
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+def is_preallocated(mosaic, surface):
+    """True when a frame was rendered without a new pixel buffer: into a scratch surface or a kept surface."""
+    if surface is None or surface is mosaic.base_surface or surface is getattr(mosaic, "previous_image_surface", None):
+        return True
+    return slide.scratch_surfaces.owns(surface)
+
+def run_mosaic(screen, mosaic, frame_ms, stage_samples, frame_allocations, stage_faults=None):
+    """Steps a mosaic on a virtual clock until it completes, timing every update + draw by the stage it was in.
+
+    With stage_faults, the page faults of every frame are recorded per stage as well.
+    """
+    current_time = mosaic.stage_start_time
+    while mosaic.is_animating():
+        current_time += frame_ms
+        stage_key = mosaic.animation_type + "/" + mosaic.animation_stage
+        faults_before = count_page_faults()
+        start = time.perf_counter()
+        screen.fill((0, 0, 0))
+        mosaic.update(current_time)
+        mosaic.draw(screen)
+        # The texture renderer does its scaling and blending here, so presenting is part of the frame
+        slide.present_display()
+        stage_samples.setdefault(stage_key, []).append((time.perf_counter() - start) * 1000)
+        if stage_faults is not None:
+            stage_faults.setdefault(stage_key, []).append(count_page_faults() - faults_before)
+        if not is_preallocated(mosaic, mosaic.current_display_surface):
+            frame_allocations[stage_key] = frame_allocations.get(stage_key, 0) + 1
+    return current_time
+
+def bench_transitions(screen, image_urls, transitions, frame_ms):
+    """Plays every animation type over consecutive images and measures frame times and transition hitches."""
+    stage_samples = {}
+    stage_faults = {}
+    frame_allocations = {}
+    hitch_samples = {"prefetched": [], "cold": []}
+    prefetcher = slide.ImagePrefetcher()
+
+    current_time = 0
+    finished_mosaic = slide.AnimatedMosaic(slide.MOSAIC_KIND_SINGLE_IMAGE, [image_urls[0]], start_time=current_time)
+    current_time = run_mosaic(screen, finished_mosaic, frame_ms, stage_samples, frame_allocations)
+
+    animation_types = (slide.ANIMATION_TYPE_SLIDE_IN, slide.ANIMATION_TYPE_FLIP, slide.ANIMATION_TYPE_CROSSFADE)
+    image_idx = 0
+    warm_scratch_buffers = len(slide.scratch_surfaces.buffers)
+    for transition in range(transitions):
+        for animation_type in animation_types:
+            image_idx = (image_idx + 1) % len(image_urls)
+            image_url = image_urls[image_idx]
+
+            # A cold transition decodes on the render thread, the way the loop worked before prefetching
+            slide.surface_cache.forget(image_url)
+            start = time.perf_counter()
+            slide.start_transition(finished_mosaic, [image_url], animation_type, slide.prepare_image(image_url), current_time)
+            hitch_samples["cold"].append((time.perf_counter() - start) * 1000)
+
+            slide.surface_cache.forget(image_url)
+            prefetcher.schedule(image_urls, image_idx)
+            for future in list(prefetcher.pending.values()):
+                future.result()
+            start = time.perf_counter()
+            mosaic = slide.start_transition(finished_mosaic, [image_url], animation_type, prefetcher.get([image_url]), current_time)
+            hitch_samples["prefetched"].append((time.perf_counter() - start) * 1000)
+
+            # The first round creates the scratch buffers, page faults are only counted once they exist. The texture
+            # backend is left out: without a GPU, SDL's software renderer allocates its own buffers to scale into.
+            count_faults = transition > 0 and slide.texture_renderer is None
+            current_time = run_mosaic(screen, mosaic, frame_ms, stage_samples, frame_allocations, stage_faults if count_faults else None)
+            finished_mosaic = mosaic
+        if transition == 0:
+            warm_scratch_buffers = len(slide.scratch_surfaces.buffers)
+
+    prefetcher.shutdown()
+    # Scratch buffers are created during the first round; any created after that is a steady-state allocation
+    frame_allocations["scratch_buffers_after_warmup"] = len(slide.scratch_surfaces.buffers) - warm_scratch_buffers
+    # A frame that faults in more pages than Python's own objects need allocated a pixel buffer somewhere,
+    # even if it was freed again before the frame ended
+    for stage_key, faults in stage_faults.items():
+        allocating_frames = sum(1 for frame_faults in faults if frame_faults > WARM_FRAME_PAGE_FAULTS)
+        if allocating_frames:
+            frame_allocations[stage_key + "/page_faults"] = allocating_frames
+    return stage_samples, hitch_samples, frame_allocations
+#endregion Benchmarks
+
+#region Report
+def print_report(results):
+    resize = results["resize"]
+    print("Resize: %d images, cold %.2fs (%.1f images/s), warm %.2fs, worker peak RSS %.0f MB" % (
+        resize["images"], resize["cold_seconds"], resize["cold_images_per_second"], resize["warm_seconds"], resize["worker_peak_rss_mb"]))
+
+    print("First image ready after %.0f ms (target %d ms)" % (resize["first_image_ms"], resize["first_frame_target_ms"]))
+
+    print("%-28s %7s %8s %8s %8s %8s %8s" % ("stage", "frames", "mean", "p50", "p95", "p99", "max"))
+    for stage_key, stats in results["stages"].items():
+        print("%-28s %7d %8.2f %8.2f %8.2f %8.2f %8.2f" % (
+            stage_key, stats["frames"], stats["mean_ms"], stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["max_ms"]))
+
+    for hitch_kind, stats in results["transition_hitch"].items():
+        print("Transition hitch (%s): mean %.2f ms, p95 %.2f ms, max %.2f ms" % (
+            hitch_kind, stats["mean_ms"], stats["p95_ms"], stats["max_ms"]))
+
+    allocations = sum(results["frame_allocations"].values())
+    print("Pixel buffers allocated by animation frames: %d" % allocations)
+
+def stage_sort_key(stage_key):
+    animation_type, stage = stage_key.split("/")
+    return (animation_type, STAGE_ORDER.index(stage) if stage in STAGE_ORDER else len(STAGE_ORDER))
+#endregion Report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless benchmark for the slideshow's ingest and render paths.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated WxH sizes of the synthetic photos")
+    parser.add_argument("--count", type=int, default=DEFAULT_COUNT, help="number of synthetic photos")
+    parser.add_argument("--transitions", type=int, default=DEFAULT_TRANSITIONS, help="rounds of slide_in, flip and crossfade to play")
+    parser.add_argument("--width", type=int, default=slide.WINDOW_WIDTH)
+    parser.add_argument("--height", type=int, default=slide.WINDOW_HEIGHT)
+    parser.add_argument("--workers", type=int, default=slide.RESIZE_WORKERS, help="resize processes, defaults to every core")
+    parser.add_argument("--backend", choices=(slide.RENDER_BACKEND_SOFTWARE, slide.RENDER_BACKEND_TEXTURE), default=slide.RENDER_BACKEND)
+    parser.add_argument("--full-decode", action="store_true", help="decode photos at full resolution before resizing, for comparison")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", help="reuse or keep the synthetic corpus in this folder instead of a temporary one")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--budget-ms", type=float, help="exit with status 1 when any stage's p95 frame time exceeds this")
+    args = parser.parse_args(argv)
+
+    slide.WINDOW_WIDTH = args.width
+    slide.WINDOW_HEIGHT = args.height
+    slide.RESIZE_FAST_DECODE = not args.full_decode
+    random.seed(args.seed)
+    if not pin_mmap_threshold() or resource is None:
+        print("Page faults are not counted here, allocations inside SDL go unchecked")
+
+    work_folder = args.corpus or tempfile.mkdtemp(prefix="slide-bench-")
+    source_folder = os.path.join(work_folder, "source")
+    destination_folder = os.path.join(work_folder, "tmp")
+    try:
+        if not os.path.exists(source_folder):
+            generate_corpus(source_folder, parse_sizes(args.sizes), args.count, args.seed)
+        if os.path.exists(destination_folder):
+            shutil.rmtree(destination_folder)
+
+        results = {"config": vars(args)}
+        results["resize"] = bench_resize(source_folder, destination_folder, args.workers)
+
+        pygame.init()
+        if args.backend == slide.RENDER_BACKEND_TEXTURE:
+            slide.texture_renderer = slide.create_texture_renderer((slide.WINDOW_WIDTH, slide.WINDOW_HEIGHT), fullscreen=False)
+        if slide.texture_renderer:
+            screen = slide.texture_renderer
+        else:
+            screen = pygame.display.set_mode((slide.WINDOW_WIDTH, slide.WINDOW_HEIGHT))
+        slide.load_images(destination_folder)
+        # Same-sized neighbours make every animation type valid between consecutive images
+        image_urls = sorted(slide.images_paths, key=image_size)
+        stage_samples, hitch_samples, frame_allocations = bench_transitions(screen, image_urls, args.transitions, 1000 / slide.ACTIVE_FPS)
+        pygame.quit()
+
+        results["stages"] = {stage_key: summarize(stage_samples[stage_key]) for stage_key in sorted(stage_samples, key=stage_sort_key)}
+        results["transition_hitch"] = {hitch_kind: summarize(samples) for hitch_kind, samples in hitch_samples.items()}
+        results["frame_allocations"] = frame_allocations
+    finally:
+        if not args.corpus:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+    if results["resize"]["first_image_ms"] > slide.FIRST_FRAME_TARGET_MS:
+        print("First image took longer than the %d ms startup target" % slide.FIRST_FRAME_TARGET_MS)
+        return 1
+    if sum(results["frame_allocations"].values()):
+        print("Animation frames allocated new pixel buffers:", results["frame_allocations"])
+        return 1
+    if args.budget_ms is not None:
+        over_budget = [stage_key for stage_key, stats in results["stages"].items() if stats["p95_ms"] > args.budget_ms]
+        if over_budget:
+            print("Over the %.2f ms budget:" % args.budget_ms, ", ".join(over_budget))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+# The banner would otherwise be the first thing in a raw stream written to stdout
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import argparse
+import hashlib
+import math
+import random
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pygame
+
+import slide
+
+#region Constants
+DEFAULT_WIDTH = 1920
+DEFAULT_HEIGHT = 1080
+DEFAULT_FPS = 30
+DEFAULT_DURATION_S = 60
+SEGMENT_SLIDES = 8 # Slides per segment, every segment replays the slide before it once
+# A stage ends on the first frame past its duration, which can add a frame per stage on top of the planned time
+SETTLE_FRAMES = 3
+FORMAT_PNG = "png"
+FORMAT_RAW = "raw"
+#endregion Constants
+
+#region Timeline
+def plan_timeline(image_urls, total_frames, frame_ms, seed):
+    """Decides every slide up front from the image index alone: what it shows, how it comes in and on which frames.
+
+    Each slide also gets a seed of its own, so a worker can rebuild any slide without replaying the ones before it.
+    """
+    rng = random.Random(seed)
+    paths = sorted(image_urls)
+    rng.shuffle(paths)
+    paths = slide.group_portraits(paths)
+
+    slides = []
+    image_idx = 0
+    start_frame = 0
+    previous_size = None
+    while start_frame < total_frames:
+        image_urls = slide.get_slide_urls(paths, image_idx)
+        display_size = slide.get_slide_display_size(image_urls)
+        animation_type = slide.ANIMATION_TYPE_SLIDE_IN
+        if previous_size is not None:
+            animation_type = slide.choose_animation_type(previous_size, display_size, rng)
+        frames = int(math.ceil(slide.get_transition_delay_ms(animation_type) / frame_ms)) + SETTLE_FRAMES
+        slides.append({
+            "image_urls": image_urls,
+            "animation_type": animation_type,
+            "seed": rng.getrandbits(32),
+            "start_frame": start_frame,
+            "frames": min(frames, total_frames - start_frame),
+        })
+        start_frame += frames
+        image_idx = (image_idx + len(image_urls)) % len(paths)
+        previous_size = display_size
+    return slides
+
+def split_segments(slides, segment_slides=SEGMENT_SLIDES):
+    return [(first, min(first + segment_slides, len(slides))) for first in range(0, len(slides), segment_slides)]
+#endregion Timeline
+
+#region Rendering
+def finish_mosaic(mosaic, current_time):
+    """Runs a mosaic to its final state. That state depends only on the slide, not on the frames that led to it."""
+    while mosaic.is_animating():
+        current_time += slide.get_transition_delay_ms(mosaic.animation_type)
+        mosaic.update(current_time)
+
+def build_mosaic(planned_slide, previous_mosaic, start_time):
+    rng = random.Random(planned_slide["seed"])
+    if previous_mosaic is None:
+        return slide.AnimatedMosaic(slide.get_mosaic_kind(planned_slide["image_urls"]), planned_slide["image_urls"],
+                                    animation_type=slide.ANIMATION_TYPE_SLIDE_IN, start_time=start_time, rng=rng)
+    return slide.start_transition(previous_mosaic, planned_slide["image_urls"], planned_slide["animation_type"], start_time=start_time, rng=rng)
+
+def replay_previous_mosaic(slides, slide_idx, frame_ms):
+    """Rebuilds the finished slide that comes before slides[slide_idx], the way it looked when the sequential render reached it."""
+    if slide_idx == 0:
+        return None
+    planned_slide = slides[slide_idx - 1]
+    start_time = planned_slide["start_frame"] * frame_ms
+    predecessor = None
+    if slide_idx > 1 and planned_slide["animation_type"] != slide.ANIMATION_TYPE_SLIDE_IN:
+        # Flip and crossfade only read their predecessor while they play, so a plain one does
+        predecessor = build_mosaic(dict(slides[slide_idx - 2], animation_type=slide.ANIMATION_TYPE_SLIDE_IN), None, start_time)
+        finish_mosaic(predecessor, start_time)
+    mosaic = build_mosaic(planned_slide, predecessor, start_time)
+    finish_mosaic(mosaic, start_time)
+    return mosaic
+
+def init_worker(width, height, image_folder):
+    slide.WINDOW_WIDTH = width
+    slide.WINDOW_HEIGHT = height
+    slide.load_image_index(image_folder)
+    pygame.init()
+    pygame.display.set_mode((width, height))
+
+def get_frame_url(output_url, frame_idx):
+    return os.path.join(output_url, "frame_%06d.png" % frame_idx)
+
+def render_segment(slides, first_slide, end_slide, frame_ms, output_format, output_url):
+    """Renders slides[first_slide:end_slide] and returns the digest of each frame, in order.
+
+    PNG frames are written straight to their final name, raw frames go to output_url as one file per segment.
+    """
+    screen = pygame.display.get_surface()
+    frame_digests = []
+    raw_file = open(output_url, "wb") if output_format == FORMAT_RAW else None
+    try:
+        current_mosaic = replay_previous_mosaic(slides, first_slide, frame_ms)
+        for slide_idx in range(first_slide, end_slide):
+            planned_slide = slides[slide_idx]
+            start_time = planned_slide["start_frame"] * frame_ms
+            finished_mosaic = current_mosaic
+            if finished_mosaic:
+                finish_mosaic(finished_mosaic, start_time)
+            current_mosaic = build_mosaic(planned_slide, finished_mosaic, start_time)
+            # Only a slide-in leaves the previous image visible behind the new one
+            background_mosaic = finished_mosaic if planned_slide["animation_type"] == slide.ANIMATION_TYPE_SLIDE_IN else None
+
+            for frame_idx in range(planned_slide["start_frame"], planned_slide["start_frame"] + planned_slide["frames"]):
+                current_time = frame_idx * frame_ms
+                screen.fill((0, 0, 0))
+                for mosaic in (background_mosaic, current_mosaic):
+                    if mosaic:
+                        mosaic.update(current_time)
+                        mosaic.draw(screen)
+                frame_bytes = pygame.image.tobytes(screen, "RGB")
+                frame_digests.append(hashlib.sha256(frame_bytes).digest())
+                if raw_file:
+                    raw_file.write(frame_bytes)
+                else:
+                    pygame.image.save(screen, get_frame_url(output_url, frame_idx))
+    finally:
+        if raw_file:
+            raw_file.close()
+    return frame_digests
+#endregion Rendering
+
+def get_export_cache_folder(source_folder):
+    """A thumbnail cache per source folder that only exports use, so an export never touches the slideshow's tmp/."""
+    source_key = hashlib.sha1(os.path.abspath(source_folder).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), "slide-export-cache", source_key)
+
+def prepare_thumbnails(source_folder, width, height, cache_folder):
+    """Brings the thumbnails for the export size up to date in cache_folder, one folder per level like the slideshow."""
+    level = slide.get_cache_level(width, height)
+    image_folder = os.path.join(cache_folder, os.path.basename(slide.get_level_folder(level)))
+    slide.resize_all_images(source_folder, image_folder, level[0], level[1])
+    manifest = slide.load_manifest(image_folder)
+    slide.load_image_index(image_folder, manifest)
+    return image_folder, [os.path.join(image_folder, entry["output"]) for entry in manifest.values()]
+
+def redirect_stdout_to_stderr():
+    """Points file descriptor 1 at stderr and returns a file for the real stdout.
+
+    Anything printed afterwards, by slide.py or by the worker processes that inherit the descriptor,
+    then ends up on stderr instead of in the middle of the raw stream.
+    """
+    sys.stdout.flush()
+    stream_fd = os.dup(1)
+    os.dup2(2, 1)
+    return os.fdopen(stream_fd, "wb")
+
+def write_raw_output(segment_urls, output_file):
+    """Joins the segments in order into output_file and returns the number of bytes written."""
+    written_bytes = 0
+    for segment_url in segment_urls:
+        with open(segment_url, "rb") as segment_file:
+            shutil.copyfileobj(segment_file, output_file)
+        written_bytes += os.path.getsize(segment_url)
+    return written_bytes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Renders the slideshow offline on a fixed-timestep clock, to a PNG sequence or a raw RGB24 stream.",
+        epilog="A raw stream can be encoded with: ffmpeg -f rawvideo -pix_fmt rgb24 -s WxH -r FPS -i OUTPUT video.mp4")
+    parser.add_argument("output", help="folder for the PNG frames, or file for the raw stream, - for stdout")
+    parser.add_argument("--format", choices=(FORMAT_PNG, FORMAT_RAW), default=FORMAT_PNG)
+    parser.add_argument("--source", default=slide.IMAGE_FOLDER_URL, help="photo folder, defaults to the slideshow's")
+    parser.add_argument("--width", type=int, default=DEFAULT_WIDTH)
+    parser.add_argument("--height", type=int, default=DEFAULT_HEIGHT)
+    parser.add_argument("--fps", type=float, default=DEFAULT_FPS)
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION_S, help="length of the export in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="the same seed, photos and settings give the same frames")
+    parser.add_argument("--workers", type=int, default=None, help="render processes, defaults to every core")
+    parser.add_argument("--segment-slides", type=int, default=SEGMENT_SLIDES, help="slides rendered by one worker task")
+    parser.add_argument("--cache", help="thumbnail cache for this export, defaults to one per source folder in the temp folder")
+    args = parser.parse_args(argv)
+    if args.output == "-" and args.format != FORMAT_RAW:
+        parser.error("only the raw format can be written to stdout")
+    raw_stdout = redirect_stdout_to_stderr() if args.output == "-" else None
+    log_file = sys.stderr if raw_stdout else sys.stdout
+
+    slide.WINDOW_WIDTH = args.width
+    slide.WINDOW_HEIGHT = args.height
+    image_folder, image_urls = prepare_thumbnails(args.source, args.width, args.height, args.cache or get_export_cache_folder(args.source))
+    if not image_urls:
+        print("No images found in", args.source, file=log_file)
+        return 1
+
+    frame_ms = 1000 / args.fps
+    slides = plan_timeline(image_urls, int(round(args.duration * args.fps)), frame_ms, args.seed)
+    segments = split_segments(slides, args.segment_slides)
+    total_frames = sum(planned_slide["frames"] for planned_slide in slides)
+    print("Exporting %d slides, %d frames, in %d segments" % (len(slides), total_frames, len(segments)), file=log_file)
+
+    if args.format == FORMAT_PNG:
+        os.makedirs(args.output, exist_ok=True)
+    segment_folder = tempfile.mkdtemp(prefix="slide-export-") if args.format == FORMAT_RAW else None
+    segment_digests = {}
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                 initargs=(args.width, args.height, image_folder)) as executor:
+            futures = {}
+            for segment_idx, (first_slide, end_slide) in enumerate(segments):
+                segment_output_url = os.path.join(segment_folder, "%06d.rgb" % segment_idx) if segment_folder else args.output
+                future = executor.submit(render_segment, slides, first_slide, end_slide, frame_ms, args.format, segment_output_url)
+                futures[future] = segment_idx
+            for completed, future in enumerate(as_completed(futures), 1):
+                segment_digests[futures[future]] = future.result()
+                print("Rendered segment %d/%d" % (completed, len(segments)), file=log_file)
+
+        if segment_folder:
+            segment_urls = [os.path.join(segment_folder, "%06d.rgb" % segment_idx) for segment_idx in range(len(segments))]
+            output_file = raw_stdout or open(args.output, "wb")
+            with output_file:
+                written_bytes = write_raw_output(segment_urls, output_file)
+            # A raw stream has no header, one byte too many or too few shifts every frame after it
+            expected_bytes = total_frames * args.width * args.height * 3
+            if written_bytes != expected_bytes:
+                print("Raw stream has %d bytes, expected %d" % (written_bytes, expected_bytes), file=log_file)
+                return 1
+    finally:
+        if segment_folder:
+            shutil.rmtree(segment_folder, ignore_errors=True)
+
+    # Independent of how the frames were split into segments, so it can be compared across runs and machines
+    export_digest = hashlib.sha256()
+    for segment_idx in range(len(segments)):
+        for frame_digest in segment_digests[segment_idx]:
+            export_digest.update(frame_digest)
+    print("Frames digest:", export_digest.hexdigest(), file=log_file)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,13 +5,41 @@ import os
 import random
 import math
 import shutil
+import json
+import time
+import contextlib
+import threading
+import queue
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from PIL import Image, ImageOps
+try:
+    import resource # Unix only, used to cap resize worker memory
+except ImportError:
+    resource = None
+try:
+    from pygame._sdl2 import video # SDL2 Renderer/Texture API, only needed for RENDER_BACKEND_TEXTURE
+except ImportError:
+    video = None
 
 #region Constants
 WINDOW_WIDTH = 1366
 WINDOW_HEIGHT = 768
 IMAGE_FOLDER_URL = "../w-slide/public/temp/"
 DESTINATION_FOLDER = "tmp/"
+MANIFEST_FILE_NAME = "manifest.json"
+MANIFEST_SAVE_INTERVAL = 100
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+RESIZE_WORKERS = None # None uses every core
+# Lets the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding, LANCZOS then does the final resample
+RESIZE_FAST_DECODE = True
+RESIZE_DRAFT_GAP = 1 # Decode to at least this many times the thumbnail size, 2 is sharper but keeps less of the speedup
+RESIZE_WORKER_MEMORY_MB = 1024 # How much a resize worker may grow by, None for no cap
+# Thumbnails are kept per resolution level in DESTINATION_FOLDER/<width>x<height>/, so a new
+# screen size only needs an incremental resize in the background instead of a full re-decode
+CACHE_LEVELS = [(1280, 720), (1366, 768), (1920, 1080), (2560, 1440), (3840, 2160)]
 
 FONT_SIZE_SM = 40
 FONT_SIZE = 60
@@ -19,37 +47,65 @@ FONT_SIZE_XLARGE = 100
 FONT_URL = "assets/segoeuil.ttf"
 TEXT_COLOR = (255, 255, 255)
 TEXT_PADDING = 20
+HUD_FPS_REFRESH_MS = 1000
 
 SLIDE_DURATION_MS = 800
 SCALE_DURATION_MS = 5000
 FLIP_DURATION_MS = 1000
 CROSSFADE_DURATION_MS = 1200
 SCALE_FACTOR = 0.05
+HOLD_DURATION_MS = 0 # How long a finished slide stays still before the next transition
 
 EXIF_KEY = 274
 MOSAIC_KIND_SINGLE_IMAGE = "single_image"
-MOSAIC_KIND_MULTI_IMAGE = "multi_image" # Not implemented yet
+MOSAIC_KIND_MULTI_IMAGE = "multi_image"
+MULTI_IMAGE_MAX = 3 # Consecutive portrait photos shown side by side on one slide
+MULTI_IMAGE_GAP = 16
 
 ANIMATION_TYPE_SLIDE_IN = "slide_in"
 ANIMATION_TYPE_FLIP = "flip"
 ANIMATION_TYPE_CROSSFADE = "crossfade"
 
+PREFETCH_DEPTH = 3
+PREFETCH_WORKERS = 2
+SURFACE_CACHE_BUDGET_BYTES = 256 * 1024 * 1024
+RENDER_BACKEND_SOFTWARE = "software"
+RENDER_BACKEND_TEXTURE = "texture" # Scaling and blending happen on the GPU when the frame is composed, see TextureRenderer
+RENDER_BACKEND = RENDER_BACKEND_SOFTWARE
+TEXTURE_CACHE_BUDGET_BYTES = 256 * 1024 * 1024
+SCRATCH_SURFACE_SLOTS = 3 # See ScratchSurfacePool for why three
+
+INGEST_ENABLED = True
+INGEST_POLL_INTERVAL_MS = 5000
+INGEST_STAT_BATCH = 2000 # Known files re-checked for in-place edits per poll
+INGEST_RESIZE_BATCH = 8 # Images resized per poll
+INGEST_EVENT_BUDGET_MS = 2 # Render thread time per frame for applying ingest and level builder events
+INGEST_PORTRAIT_PROBES = 32 # Playlist positions looked at to find a portrait slide with room for a new portrait
+
+ACTIVE_FPS = 120
+IDLE_FPS = 10
+
+FIRST_FRAME_TARGET_MS = 2000 # Startup to the first slide on screen, reported by the profiler and bench.py
+PROFILE = False
+PROFILE_DUMP_URL = "profile.json"
+PROFILE_DUMP_INTERVAL_MS = 60000
+PROFILE_BUCKET_MS = 0.5
+PROFILE_MAX_MS = 250
+FONT_SIZE_DEBUG = 22
+
 DEBUG = False
 #endregion Constants
 
 #region Init
-pygame.init()
-#screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), pygame.RESIZABLE)
-screen = pygame.display.set_mode((0 ,0), pygame.FULLSCREEN)
-clock = pygame.time.Clock()
-font_small = pygame.freetype.Font(FONT_URL, FONT_SIZE_SM)
-font = pygame.freetype.Font(FONT_URL, FONT_SIZE)
-font_xlarge = pygame.freetype.Font(FONT_URL, FONT_SIZE_XLARGE)
 images_paths = []
 current_image_idx = 0
 current_display_mosaic = None
 background_mosaic = None
 running = True
+image_index = {} # thumbnail url -> (width, height, EXIF orientation), see load_image_index
+cache_level = None
+image_folder = None
+texture_renderer = None # Set when drawing through RENDER_BACKEND_TEXTURE
 #endregion Init
 
 #region TextFunctions
@@ -58,13 +114,83 @@ def zero_fix(num):
         return "0" + str(num)
     return str(num)
 
-def print_date():
-    text_surface, rect = font.render(datetime.datetime.now().strftime("%A, %B %d"), TEXT_COLOR)
-    screen.blit(text_surface, (TEXT_PADDING, WINDOW_HEIGHT - 100))
+class CachedText:
+    """Keeps the rendered surface of a piece of text and only re-renders it when the text changes."""
+    def __init__(self, font):
+        self.font = font
+        self.text = None
+        self.surface = None
+        self.rect = pygame.Rect(0, 0, 0, 0)
+
+    def update(self, text, position):
+        """Returns the screen area that has to be redrawn, or None when nothing changed."""
+        if text == self.text and self.rect.topleft == position:
+            return None
+        previous_rect = self.rect
+        if text != self.text:
+            text_surface, rect = self.font.render(text, TEXT_COLOR)
+            self.surface = convert_for_display(text_surface)
+            self.text = text
+        self.rect = self.surface.get_rect(topleft=position)
+        if previous_rect.width == 0 or previous_rect.height == 0:
+            return self.rect
+        return previous_rect.union(self.rect)
+
+    def draw(self, surface):
+        surface.blit(self.surface, self.rect)
+
+class Hud:
+    def __init__(self, font_small, font, font_xlarge, font_debug=None):
+        self.date_text = CachedText(font)
+        self.time_text = CachedText(font_xlarge)
+        self.fps_text = CachedText(font_small)
+        self.fps = 0
+        self.fps_sample_time = None
+        # The profiler overlay is only built when there is a font for it
+        self.debug_texts = [CachedText(font_debug) for _ in range(4)] if font_debug else []
+        self.debug_lines = [""] * len(self.debug_texts)
+
+    def update(self, clock, current_time_ms, stage_key=None):
+        """Refreshes the HUD strings and returns the screen areas whose text changed."""
+        now = datetime.datetime.now()
+        # The FPS readout is sampled once per HUD_FPS_REFRESH_MS, otherwise it would change every frame
+        if self.fps_sample_time is None or current_time_ms - self.fps_sample_time >= HUD_FPS_REFRESH_MS:
+            self.fps = int(clock.get_fps())
+            self.fps_sample_time = current_time_ms
+            if self.debug_texts:
+                self.debug_lines = self._build_debug_lines(stage_key)
+
+        dirty_rects = [
+            self.date_text.update(now.strftime("%A, %B %d"), (TEXT_PADDING, WINDOW_HEIGHT - 100)),
+            self.time_text.update(zero_fix(now.hour) + ":" + zero_fix(now.minute), (TEXT_PADDING, WINDOW_HEIGHT - 180)),
+            self.fps_text.update(f"FPS: {self.fps}", (TEXT_PADDING, TEXT_PADDING)),
+        ]
+        for idx, debug_text in enumerate(self.debug_texts):
+            debug_position = (TEXT_PADDING, TEXT_PADDING + FONT_SIZE_SM + idx * (FONT_SIZE_DEBUG + 4))
+            dirty_rects.append(debug_text.update(self.debug_lines[idx] or " ", debug_position))
+        return [rect for rect in dirty_rects if rect]
+
+    def _build_debug_lines(self, stage_key):
+        cache_stats = surface_cache.stats()
+        cache_line = (f"surface cache: {cache_stats['entries']} surfaces, {cache_stats['used_bytes'] // (1024 * 1024)} MB, "
+                      f"{cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['evictions']} evictions")
+        stats = profiler.summary(stage_key) if stage_key else None
+        if not stats:
+            return [stage_key or "", "", "", cache_line]
+        sections = ", ".join(f"{name} {elapsed_ms:.1f}" for name, elapsed_ms in sorted(stats["section_ms_per_frame"].items()))
+        return [
+            f"{stage_key}: {stats['frames']} frames, {stats['dropped_frames']} dropped",
+            f"p50 {stats['p50_ms']:.1f}  p95 {stats['p95_ms']:.1f}  p99 {stats['p99_ms']:.1f}  max {stats['max_ms']:.1f} ms",
+            f"per frame: {sections} ms",
+            cache_line,
+        ]
 
-def print_time():
-    text_surface, rect = font_xlarge.render(zero_fix(datetime.datetime.now().hour) + ":" + zero_fix(datetime.datetime.now().minute), TEXT_COLOR)
-    screen.blit(text_surface, (TEXT_PADDING, WINDOW_HEIGHT - 180))
+    def draw(self, surface):
+        self.date_text.draw(surface)
+        self.time_text.draw(surface)
+        self.fps_text.draw(surface)
+        for debug_text in self.debug_texts:
+            debug_text.draw(surface)
 #endregion TextFunctions
 
 #region ImageFunctions
@@ -75,14 +201,16 @@ def copy_folder(folder_url, destination_folder):
         os.mkdir(destination_folder)
     shutil.copytree(folder_url, destination_folder)
 
+def is_image_file(file):
+    return not file.startswith(".") and file.lower().endswith(IMAGE_EXTENSIONS)
+
 def load_images(folder_url):
     for root, dirs, files in os.walk(folder_url):
         for file in files:
-            if file.startswith("."):
-                continue
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
+            if is_image_file(file):
                 images_paths.append(os.path.join(root, file))
     random.shuffle(images_paths)
+    images_paths[:] = group_portraits(images_paths)
 
 def get_orientation(image_url):
     try:
@@ -96,80 +224,1165 @@ def get_orientation(image_url):
         return 0
     return 0
 
-def resize_all_images(folder_url, destination_folder, width, height):
+def load_manifest(destination_folder):
+    manifest_url = os.path.join(destination_folder, MANIFEST_FILE_NAME)
+    try:
+        with open(manifest_url) as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(destination_folder, manifest):
+    manifest_url = os.path.join(destination_folder, MANIFEST_FILE_NAME)
+    with open(manifest_url + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_url + ".tmp", manifest_url)
+
+def build_manifest_entry(image_url, source_key, width, height):
+    """The manifest remembers which source file, at which size, produced each thumbnail."""
+    stat = os.stat(image_url)
+    return {"mtime": stat.st_mtime_ns, "size": stat.st_size, "target": [width, height], "output": source_key}
+
+def is_manifest_entry_fresh(previous_entry, entry):
+    if not previous_entry:
+        return False
+    for key in ("mtime", "size", "target", "output"):
+        if previous_entry.get(key) != entry[key]:
+            return False
+    return True
+
+def reuse_manifest_entry(previous_entry, destination_image_url):
+    """Keeps the entry of a thumbnail that is still fresh, with the size and orientation recorded when it was written.
+
+    Manifests from before that metadata existed get it filled in from the thumbnail once, so it is
+    saved with the manifest instead of being read again on the render thread.
+    """
+    if "width" not in previous_entry:
+        try:
+            with Image.open(destination_image_url) as img:
+                previous_entry["width"], previous_entry["height"] = img.size
+        except IOError:
+            return previous_entry
+        previous_entry["orientation"] = get_orientation(destination_image_url)
+    return previous_entry
+
+def evict_stale_outputs(destination_folder, manifest):
+    """Removes thumbnails whose source was deleted, renamed or failed to resize."""
+    outputs = set(os.path.normpath(entry["output"]) for entry in manifest.values())
+    for root, dirs, files in os.walk(destination_folder, topdown=False):
+        for file in files:
+            output_url = os.path.join(root, file)
+            output_key = os.path.normpath(os.path.relpath(output_url, destination_folder))
+            if output_key.startswith(MANIFEST_FILE_NAME) or output_key in outputs:
+                continue
+            if DEBUG: print("Evicting stale image:", output_url)
+            os.remove(output_url)
+        if root != destination_folder and not os.listdir(root):
+            os.rmdir(root)
+
+def resize_all_images(folder_url, destination_folder, width, height, workers=RESIZE_WORKERS, on_image_ready=None, evict_stale=True):
+    """Brings destination_folder up to date with folder_url.
+
+    on_image_ready(thumbnail_url, entry) is called for each thumbnail as soon as it is written, so
+    a caller can start using them before the whole folder is done. With evict_stale=False, thumbnails
+    of removed photos are left for the caller to evict once nothing points at them any more.
+    """
     if not os.path.exists(destination_folder):
-        os.mkdir(destination_folder)
+        os.makedirs(destination_folder)
 
+    previous_manifest = load_manifest(destination_folder)
+    manifest = {}
+    jobs = []
     for root, dirs, files in os.walk(folder_url):
         for file in files:
-            if file.startswith("."):
+            if not is_image_file(file):
+                continue
+            image_url = os.path.join(root, file)
+            # Keying on the path relative to the source keeps same-named files in different folders apart
+            source_key = os.path.relpath(image_url, folder_url)
+            try:
+                entry = build_manifest_entry(image_url, source_key, width, height)
+            except OSError:
                 continue
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-                resize_image(root, file, destination_folder, width, height)
-
-def resize_image(root, file, destination_folder, width, height):
-    image_url = os.path.join(root, file)
-    destination_image_url = os.path.join(destination_folder, file)
-    if DEBUG: print("Processing image:", image_url)
-    if not os.path.exists(destination_image_url):
-        if DEBUG: print("Resizing image:", image_url)
+            destination_image_url = os.path.join(destination_folder, entry["output"])
+            if is_manifest_entry_fresh(previous_manifest.get(source_key), entry) and os.path.exists(destination_image_url):
+                if DEBUG: print("Image already exists:", destination_image_url)
+                manifest[source_key] = reuse_manifest_entry(previous_manifest[source_key], destination_image_url)
+            else:
+                jobs.append((source_key, image_url, destination_image_url, entry))
+
+    if jobs:
+        if DEBUG: print("Resizing", len(jobs), "images")
+        # Workers are spawned rather than forked: by now the prefetcher, ingest and level builder threads may
+        # be running, and a fork copies whatever locks they hold. A spawned worker only has what is passed to it.
+        os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1") # Each worker imports pygame again
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=limit_worker_memory, initargs=(RESIZE_WORKER_MEMORY_MB,)) as executor:
+            futures = {}
+            for source_key, image_url, destination_image_url, entry in jobs:
+                future = executor.submit(resize_image, image_url, destination_image_url, width, height, RESIZE_FAST_DECODE)
+                futures[future] = (source_key, entry)
+            for completed, future in enumerate(as_completed(futures), 1):
+                source_key, entry = futures[future]
+                try:
+                    image_info = future.result()
+                except BrokenProcessPool:
+                    # A worker died, e.g. killed for running out of memory, and took the pool with it.
+                    # Keep what was finished so the next run only redoes the rest.
+                    save_manifest(destination_folder, manifest)
+                    raise
+                if image_info:
+                    entry.update(image_info)
+                    manifest[source_key] = entry
+                    if on_image_ready:
+                        on_image_ready(os.path.join(destination_folder, entry["output"]), entry)
+                # Saving along the way means an interrupted cold start does not have to begin again
+                if completed % MANIFEST_SAVE_INTERVAL == 0:
+                    save_manifest(destination_folder, manifest)
+
+    if evict_stale:
+        evict_stale_outputs(destination_folder, manifest)
+    save_manifest(destination_folder, manifest)
+
+def limit_worker_memory(limit_mb):
+    """Process pool initializer. Caps how far a resize worker can grow, so one enormous photo fails on its own."""
+    if resource is None or not limit_mb:
+        return
+    try:
+        # A worker has already imported pygame and PIL by now, so the cap goes on top of that
+        with open("/proc/self/statm") as statm:
+            in_use = int(statm.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError):
+        in_use = 0
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = in_use + limit_mb * 1024 * 1024
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    except (ValueError, OSError):
+        if DEBUG: print("Could not cap resize worker memory")
+
+def draft_for_thumbnail(img, width, height):
+    """Asks the JPEG decoder for a reduced-resolution decode that still covers the thumbnail. No-op for other formats."""
+    source_width, source_height = img.size
+    # The box applies after exif_transpose, so swap it for photos stored on their side
+    if img.getexif().get(EXIF_KEY) in (5, 6, 7, 8):
+        width, height = height, width
+    scale = min(width / source_width, height / source_height)
+    if scale >= 1:
+        return
+    img.draft(None, (int(source_width * scale * RESIZE_DRAFT_GAP), int(source_height * scale * RESIZE_DRAFT_GAP)))
+
+def resize_image(image_url, destination_image_url, width, height, fast_decode=None):
+    """Writes the thumbnail and returns its metadata for the manifest, or None if the image could not be read.
+
+    Pass fast_decode explicitly from a spawned worker, which does not see RESIZE_FAST_DECODE changes made at run time.
+    """
+    if fast_decode is None:
+        fast_decode = RESIZE_FAST_DECODE
+    if DEBUG: print("Resizing image:", image_url)
+    try:
+        destination_dir = os.path.dirname(destination_image_url)
+        if destination_dir and not os.path.exists(destination_dir):
+            os.makedirs(destination_dir, exist_ok=True)
+        with Image.open(image_url) as img:
+            # Has to happen before exif_transpose, which decodes the whole image
+            if fast_decode:
+                draft_for_thumbnail(img, width, height)
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((width, height), Image.Resampling.LANCZOS)
+            img.save(destination_image_url)
+            thumbnail_width, thumbnail_height = img.size
+    except (IOError, ValueError, Image.DecompressionBombError):
+        print("Error resizing image:", image_url)
+        return None
+    except MemoryError:
+        print("Not enough memory to resize image:", image_url)
+        return None
+    # Recorded in the manifest so the render thread never has to open the thumbnail to learn its shape
+    return {"width": thumbnail_width, "height": thumbnail_height, "orientation": get_orientation(destination_image_url)}
+
+def load_image_index(destination_folder, manifest=None):
+    """Fills image_index from the metadata resize_image stored in the manifest."""
+    if manifest is None:
+        manifest = load_manifest(destination_folder)
+    for entry in manifest.values():
+        if "width" in entry:
+            image_index[os.path.join(destination_folder, entry["output"])] = (entry["width"], entry["height"], entry["orientation"])
+
+def get_image_info(image_url):
+    """Returns (width, height, orientation) of an image file, from the index when it is there."""
+    image_info = image_index.get(image_url)
+    if image_info is None:
+        # Only images that never went through resize_image end up reading the file header
         try:
             with Image.open(image_url) as img:
-                img = ImageOps.exif_transpose(img)
-                img.thumbnail((width, height), Image.Resampling.LANCZOS)
-                img.save(destination_image_url)
+                width, height = img.size
         except IOError:
-            print("Error resizing image:", image_url)
-    else:
-        if DEBUG: print("Image already exists:", destination_image_url)
+            width, height = 0, 0
+        image_info = (width, height, get_orientation(image_url))
+        image_index[image_url] = image_info
+    return image_info
+
+def prepare_image(image_url):
+    """Decodes an image and applies its EXIF orientation. Safe to call from worker threads."""
+    image = pygame.image.load(image_url)
+    orientation = get_image_info(image_url)[2]
+
+    if orientation == 3:
+        image = pygame.transform.rotate(image, 180)
+    elif orientation == 6:
+        image = pygame.transform.rotate(image, -90)
+    elif orientation == 8:
+        image = pygame.transform.rotate(image, 90)
+
+    # PNGs and GIFs often carry an alpha channel they never use. Dropping it here lets them
+    # take the opaque display format and the fast surface-alpha blit during crossfades.
+    if image.get_flags() & pygame.SRCALPHA and is_opaque(image):
+        opaque_image = pygame.Surface(image.get_size(), 0, 24)
+        opaque_image.blit(image, (0, 0))
+        image = opaque_image
+    return image
+
+def get_image_size(image_url):
+    """Returns the width and height of an image as displayed, after its EXIF orientation is applied."""
+    width, height, orientation = get_image_info(image_url)
+    if orientation in (6, 8):
+        return height, width
+    return width, height
+
+def get_slide_display_size(image_urls):
+    # Multi-image slides are always composited at window size
+    if len(image_urls) > 1:
+        return WINDOW_WIDTH, WINDOW_HEIGHT
+    return get_display_size(*get_image_size(image_urls[0]))
+
+def is_portrait(image_url):
+    width, height = get_image_size(image_url)
+    return height > width
+
+def group_portraits(paths):
+    """Reorders a playlist so each portrait is followed by the next portraits in it, up to MULTI_IMAGE_MAX.
+
+    Landscapes keep their order and each group takes the place of its first portrait, so
+    get_slide_urls, which only looks at neighbours, pairs portraits that were far apart.
+    """
+    slots = []
+    open_group = None
+    for path in paths:
+        if not is_portrait(path):
+            slots.append([path])
+        elif open_group is not None and len(open_group) < MULTI_IMAGE_MAX:
+            open_group.append(path)
+        else:
+            open_group = [path]
+            slots.append(open_group)
+    return [path for slot in slots for path in slot]
+
+def get_slide_urls(paths, idx):
+    """Returns the images shown by the slide that starts at idx: a run of portraits, or a single image."""
+    slide_urls = [paths[idx]]
+    if not is_portrait(paths[idx]):
+        return slide_urls
+    while len(slide_urls) < MULTI_IMAGE_MAX and idx + len(slide_urls) < len(paths) and is_portrait(paths[idx + len(slide_urls)]):
+        slide_urls.append(paths[idx + len(slide_urls)])
+    return slide_urls
+
+def get_mosaic_kind(image_urls):
+    return MOSAIC_KIND_MULTI_IMAGE if len(image_urls) > 1 else MOSAIC_KIND_SINGLE_IMAGE
+
+def compose_images(image_urls):
+    """Lays the images out side by side on one window-sized surface. Safe to call from worker threads."""
+    canvas = pygame.Surface((WINDOW_WIDTH, WINDOW_HEIGHT), 0, 24)
+    cell_width = (WINDOW_WIDTH - MULTI_IMAGE_GAP * (len(image_urls) + 1)) / len(image_urls)
+    cell_height = WINDOW_HEIGHT - MULTI_IMAGE_GAP * 2
+    for idx, image_url in enumerate(image_urls):
+        image = prepare_image(image_url)
+        fit_scale = min(cell_width / image.get_width(), cell_height / image.get_height())
+        fit_size = (max(1, int(image.get_width() * fit_scale)), max(1, int(image.get_height() * fit_scale)))
+        if image.get_bitsize() not in (24, 32):
+            image = image.convert(24)
+        image = pygame.transform.smoothscale(image, fit_size)
+        cell_x = MULTI_IMAGE_GAP + idx * (cell_width + MULTI_IMAGE_GAP)
+        canvas.blit(image, (int(cell_x + (cell_width - fit_size[0]) / 2), int(MULTI_IMAGE_GAP + (cell_height - fit_size[1]) / 2)))
+    return canvas
+
+def prepare_slide(image_urls):
+    if len(image_urls) > 1:
+        return compose_images(image_urls)
+    return prepare_image(image_urls[0])
+
+def is_opaque(surface):
+    if not surface.get_flags() & pygame.SRCALPHA:
+        return True
+    return pygame.mask.from_surface(surface, 254).count() == surface.get_width() * surface.get_height()
+
+def convert_for_display(surface):
+    """Converts to the display's native format, keeping per-pixel alpha only for images that need it."""
+    if texture_renderer:
+        # There is no display surface to match, the pixels are converted once when uploaded as a texture.
+        # Palette images (GIFs, palette PNGs) still need widening, smoothscale only takes 24 and 32 bits.
+        if surface.get_bitsize() not in (24, 32):
+            return surface.convert(32)
+        return surface
+    if surface.get_flags() & pygame.SRCALPHA:
+        return surface.convert_alpha()
+    return surface.convert()
+
+def get_display_size(width, height):
+    if width > WINDOW_WIDTH or height > WINDOW_HEIGHT:
+        if width > height:
+            scale_factor_r = WINDOW_WIDTH / width
+        else:
+            scale_factor_r = WINDOW_HEIGHT / height
+        width = int(width * scale_factor_r)
+        height = int(height * scale_factor_r)
+    return width, height
 #endregion ImageFunctions
 
+#region SurfaceCache
+class SurfaceCache:
+    """LRU cache of display-ready surfaces shared by every mosaic, bounded by the bytes their pixels use.
+
+    Keys are (image urls, size) tuples, see get_slide_cache_key. Only the render thread uses it.
+    Cached surfaces are shared, so callers must not leave state such as set_alpha on them.
+    """
+    def __init__(self, budget_bytes=SURFACE_CACHE_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def surface_bytes(surface):
+        return surface.get_pitch() * surface.get_height()
+
+    def peek(self, key):
+        """Looks a surface up without counting it or refreshing its position."""
+        return self.entries.get(key)
+
+    def get(self, key):
+        surface = self.entries.get(key)
+        if surface is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return surface
+
+    def put(self, key, surface):
+        size_bytes = self.surface_bytes(surface)
+        if size_bytes > self.budget_bytes:
+            return
+        if key in self.entries:
+            self.used_bytes -= self.surface_bytes(self.entries.pop(key))
+        self.entries[key] = surface
+        self.used_bytes += size_bytes
+        while self.used_bytes > self.budget_bytes:
+            evicted_key, evicted_surface = self.entries.popitem(last=False)
+            self.used_bytes -= self.surface_bytes(evicted_surface)
+            self.evictions += 1
+            if DEBUG: print("Evicted surface:", evicted_key)
+
+    def forget(self, image_url):
+        """Drops every surface made from image_url, e.g. because the file changed on disk."""
+        for key in [key for key in self.entries if image_url in key[0]]:
+            self.used_bytes -= self.surface_bytes(self.entries.pop(key))
+
+    def clear(self):
+        self.entries.clear()
+        self.used_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "used_bytes": self.used_bytes,
+            "budget_bytes": self.budget_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+def get_slide_cache_key(image_urls, size=None):
+    # Multi-image composites are laid out for the window, so the window size is part of their key
+    if size is None and len(image_urls) > 1:
+        size = (WINDOW_WIDTH, WINDOW_HEIGHT)
+    return (tuple(image_urls), size)
+
+surface_cache = SurfaceCache()
+
+class ScratchSurfacePool:
+    """Window-sized destination surfaces that the per-frame scaling in AnimatedMosaic renders into.
+
+    Each mosaic takes the next slot in rotation and keeps it for its lifetime. At most two mosaics
+    are drawn in a frame: the current one and the one it replaces, either behind a slide-in or as
+    the fading-out side of a crossfade. SCRATCH_SURFACE_SLOTS keeps one slot more than that, so a
+    mosaic that is built but dropped without being drawn, like the predecessor export.py rebuilds at
+    a segment boundary or bench.py's cold transitions, never takes the slot of a mosaic still on
+    screen. Each slot has more than one layer for scaling done in several passes. After the first
+    few slides animation allocates no pixel buffers at all.
+    """
+    def __init__(self, slots=SCRATCH_SURFACE_SLOTS):
+        self.slots = slots
+        self.next_slot = 0
+        self.buffers = {}
+
+    def acquire_slot(self):
+        slot = self.next_slot
+        self.next_slot = (self.next_slot + 1) % self.slots
+        return slot
+
+    def get(self, slot, source, size, layer=0):
+        """Returns a size-sized view into the slot's buffer for layer that has source's pixel format."""
+        format_key = (slot, layer, source.get_bitsize(), source.get_flags() & pygame.SRCALPHA, source.get_masks())
+        buffer = self.buffers.get(format_key)
+        if buffer is None or buffer.get_width() < size[0] or buffer.get_height() < size[1]:
+            buffer_size = (max(WINDOW_WIDTH, size[0]), max(WINDOW_HEIGHT, size[1]))
+            buffer = pygame.Surface(buffer_size, source.get_flags() & pygame.SRCALPHA, source)
+            self.buffers[format_key] = buffer
+        return buffer.subsurface((0, 0, size[0], size[1]))
+
+    def owns(self, surface):
+        while surface.get_parent() is not None:
+            surface = surface.get_parent()
+        return any(surface is buffer for buffer in self.buffers.values())
+
+    def clear(self):
+        self.buffers.clear()
+
+scratch_surfaces = ScratchSurfacePool()
+#endregion SurfaceCache
+
+#region TextureRenderer
+class TextureRenderer:
+    """Draws through SDL2's Renderer, so scaling and alpha blending happen when the frame is composed.
+
+    It stands in for the display surface: mosaics and the HUD call fill, set_clip and blit on it as
+    on a Surface. blit stretches the area of the source to the size of a Rect destination and takes
+    the source's surface alpha. A surface is uploaded the first time it is drawn and its texture kept
+    in a byte-budgeted LRU, so surfaces must not change once they have been drawn.
+    """
+    def __init__(self, window, budget_bytes=TEXTURE_CACHE_BUDGET_BYTES):
+        # Textures are sampled linearly when stretched, closer to smoothscale than SDL's nearest default
+        os.environ.setdefault("SDL_RENDER_SCALE_QUALITY", "1")
+        self.window = window
+        try:
+            self.renderer = video.Renderer(window, accelerated=1)
+            self.accelerated = True
+        except RuntimeError:
+            # No GPU: SDL's software renderer takes the same calls, just slower
+            self.renderer = video.Renderer(window, accelerated=0)
+            self.accelerated = False
+        if DEBUG: print("Texture renderer, accelerated:", self.accelerated)
+        self.budget_bytes = budget_bytes
+        self.textures = OrderedDict() # id(surface) -> (surface, texture), the surface is kept so its id stays unique
+        self.used_bytes = 0
+
+    def get_size(self):
+        return self.window.size
+
+    def get_texture(self, surface):
+        entry = self.textures.get(id(surface))
+        if entry is not None:
+            self.textures.move_to_end(id(surface))
+            return entry[1]
+        with profiler.section("upload"):
+            texture = video.Texture.from_surface(self.renderer, surface)
+        texture.blend_mode = 1 # SDL_BLENDMODE_BLEND, so the alpha set in blit fades the texture
+        self.textures[id(surface)] = (surface, texture)
+        self.used_bytes += SurfaceCache.surface_bytes(surface)
+        while self.used_bytes > self.budget_bytes and len(self.textures) > 1:
+            evicted_surface = self.textures.popitem(last=False)[1][0]
+            self.used_bytes -= SurfaceCache.surface_bytes(evicted_surface)
+        return texture
+
+    def fill(self, color):
+        self.renderer.draw_color = pygame.Color(color)
+        self.renderer.clear()
+
+    def set_clip(self, rect):
+        """Every present shows a whole frame, so there is no partial redraw to clip."""
+
+    def blit(self, source, dest, area=None):
+        if source.get_width() == 0 or source.get_height() == 0:
+            return
+        texture = self.get_texture(source)
+        alpha = source.get_alpha()
+        texture.alpha = 255 if alpha is None else alpha
+        if isinstance(dest, pygame.Rect):
+            dest_rect = dest
+        else:
+            dest_rect = pygame.Rect(dest, area.size if area else source.get_size())
+        texture.draw(srcrect=area, dstrect=dest_rect)
+
+    def present(self):
+        self.renderer.present()
+
+def create_texture_renderer(size, fullscreen=True):
+    """Opens the window for RENDER_BACKEND_TEXTURE. Returns None when pygame has no SDL2 video module."""
+    if video is None:
+        print("pygame._sdl2.video is not available, drawing in software")
+        return None
+    # An SDL renderer cannot share its window with pygame.display's surface, so it gets its own window
+    window = video.Window("Slide", size=size, fullscreen_desktop=fullscreen, resizable=not fullscreen)
+    return TextureRenderer(window)
+
+def present_display(dirty_rects=None):
+    if texture_renderer:
+        texture_renderer.present()
+    elif dirty_rects is None:
+        pygame.display.flip()
+    else:
+        pygame.display.update(dirty_rects)
+#endregion TextureRenderer
+
+#region Prefetch
+class ImagePrefetcher:
+    """Decodes the upcoming entries of the playlist on worker threads so transitions never wait on disk."""
+    def __init__(self, depth=PREFETCH_DEPTH, workers=PREFETCH_WORKERS):
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self.pending = {}
+
+    def schedule(self, paths, next_idx):
+        """Starts preparing the slides that follow, beginning with the one at next_idx."""
+        if not paths:
+            return
+        wanted = []
+        idx = next_idx % len(paths)
+        for _ in range(self.depth):
+            slide_urls = tuple(get_slide_urls(paths, idx))
+            wanted.append(slide_urls)
+            idx = (idx + len(slide_urls)) % len(paths)
+        for slide_urls in list(self.pending):
+            if slide_urls not in wanted:
+                self.pending.pop(slide_urls).cancel()
+        for slide_urls in wanted:
+            if slide_urls not in self.pending and surface_cache.peek(get_slide_cache_key(slide_urls)) is None:
+                self.pending[slide_urls] = self.executor.submit(prepare_slide, slide_urls)
+
+    def get(self, image_urls):
+        """Returns the prepared surface for a slide, decoding it now if it was never scheduled."""
+        future = self.pending.pop(tuple(image_urls), None)
+        cached_surface = surface_cache.peek(get_slide_cache_key(image_urls))
+        if future is None and cached_surface is not None:
+            return cached_surface
+        if future is not None:
+            try:
+                return future.result()
+            except (pygame.error, IOError):
+                if DEBUG: print("Prefetch failed, retrying:", image_urls)
+        return prepare_slide(image_urls)
+
+    def clear(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+
+    def forget(self, image_url):
+        """Drops prepared slides that contain image_url, e.g. because the file changed on disk."""
+        for slide_urls in list(self.pending):
+            if image_url in slide_urls:
+                self.pending.pop(slide_urls).cancel()
+
+    def shutdown(self):
+        self.clear()
+        self.executor.shutdown(wait=False)
+#endregion Prefetch
+
+#region Profiling
+class FrameHistogram:
+    """Fixed-bucket frame-time histogram, so a kiosk can keep profiling for weeks in constant memory."""
+    def __init__(self, bucket_ms=PROFILE_BUCKET_MS, max_ms=PROFILE_MAX_MS):
+        self.bucket_ms = bucket_ms
+        self.buckets = [0] * (int(max_ms / bucket_ms) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.dropped_frames = 0
+        self.section_ms = {}
+
+    def add(self, frame_ms, dropped_frames, section_ms):
+        self.buckets[min(len(self.buckets) - 1, int(frame_ms / self.bucket_ms))] += 1
+        self.count += 1
+        self.total_ms += frame_ms
+        self.max_ms = max(self.max_ms, frame_ms)
+        self.dropped_frames += dropped_frames
+        for name, elapsed_ms in section_ms.items():
+            self.section_ms[name] = self.section_ms.get(name, 0.0) + elapsed_ms
+
+    def percentile(self, fraction):
+        if self.count == 0:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for idx, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= target:
+                return min(self.max_ms, (idx + 1) * self.bucket_ms)
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+            "frames": self.count,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0,
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": self.max_ms,
+            "dropped_frames": self.dropped_frames,
+            "section_ms_per_frame": {name: elapsed_ms / self.count for name, elapsed_ms in self.section_ms.items()} if self.count else {},
+            "histogram": {"bucket_ms": self.bucket_ms, "counts": self.buckets[:max(idx for idx, bucket in enumerate(self.buckets) if bucket) + 1] if self.count else []},
+        }
+
+class ProfilerSection:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.child_ms = 0.0
+        self.profiler.section_stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        self.profiler.section_stack.pop()
+        # Time spent in nested sections is only counted once, against the innermost one
+        if self.profiler.section_stack:
+            self.profiler.section_stack[-1].child_ms += elapsed_ms
+        self.profiler.frame_section_ms[self.name] = self.profiler.frame_section_ms.get(self.name, 0.0) + elapsed_ms - self.child_ms
+        return False
+
+class FrameProfiler:
+    """Records per animation stage frame times, dropped frames and where the time went (load, scale, blit, present)."""
+    def __init__(self, enabled=PROFILE, active_fps=ACTIVE_FPS):
+        self.enabled = enabled
+        self.frame_budget_ms = 1000 / active_fps
+        self.histograms = {}
+        self.section_stack = []
+        self.frame_section_ms = {}
+        self.frame_start = None
+        self.previous_frame_start = None
+        self.previous_frame_idle = False
+        self.last_dump_time = None
+        self.first_frame_ms = None
+
+    def section(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return ProfilerSection(self, name)
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        self.previous_frame_start = self.frame_start
+        self.frame_start = time.perf_counter()
+        self.frame_section_ms = {}
+
+    def end_frame(self, stage_key, idle=False):
+        if not self.enabled or self.frame_start is None:
+            return
+        frame_ms = (time.perf_counter() - self.frame_start) * 1000
+        # Frame slots that went by between two frame starts count as dropped. Idle frames are slow on purpose,
+        # and so is the gap in front of the first active frame after them, which still ran at IDLE_FPS.
+        dropped_frames = 0
+        if not idle and not self.previous_frame_idle and self.previous_frame_start is not None:
+            interval_ms = (self.frame_start - self.previous_frame_start) * 1000
+            dropped_frames = max(0, int(interval_ms / self.frame_budget_ms) - 1)
+        self.previous_frame_idle = idle
+        if stage_key not in self.histograms:
+            self.histograms[stage_key] = FrameHistogram()
+        self.histograms[stage_key].add(frame_ms, dropped_frames, self.frame_section_ms)
+
+    def record_first_frame(self, first_frame_ms):
+        """Kept even when profiling is off, so a slow startup is always reported."""
+        self.first_frame_ms = first_frame_ms
+        if DEBUG or first_frame_ms > FIRST_FRAME_TARGET_MS:
+            print("Time to first frame: %d ms (target %d ms)" % (first_frame_ms, FIRST_FRAME_TARGET_MS))
+
+    def summary(self, stage_key):
+        histogram = self.histograms.get(stage_key)
+        return histogram.to_dict() if histogram else None
+
+    def to_dict(self):
+        return {
+            "frame_budget_ms": self.frame_budget_ms,
+            "first_frame_ms": self.first_frame_ms,
+            "first_frame_target_ms": FIRST_FRAME_TARGET_MS,
+            "stages": {stage_key: histogram.to_dict() for stage_key, histogram in self.histograms.items()},
+            "surface_cache": surface_cache.stats(),
+        }
+
+    def dump(self, profile_url, current_time_ms=None):
+        """Writes the collected stats as JSON, at most once per PROFILE_DUMP_INTERVAL_MS when a time is given."""
+        if not self.enabled:
+            return
+        if current_time_ms is not None:
+            if self.last_dump_time is not None and current_time_ms - self.last_dump_time < PROFILE_DUMP_INTERVAL_MS:
+                return
+            self.last_dump_time = current_time_ms
+        with open(profile_url + ".tmp", "w") as profile_file:
+            json.dump(self.to_dict(), profile_file, indent=2)
+        os.replace(profile_url + ".tmp", profile_url)
+
+profiler = FrameProfiler()
+#endregion Profiling
+
+#region CacheLevels
+def get_level_folder(level):
+    return os.path.join(DESTINATION_FOLDER, str(level[0]) + "x" + str(level[1]))
+
+def get_cache_level(width, height, levels=CACHE_LEVELS):
+    """Returns the smallest level that covers width x height, or the largest one when none does."""
+    for level in sorted(levels):
+        if level[0] >= width and level[1] >= height:
+            return level
+    return max(levels)
+
+def get_available_cache_levels():
+    return [level for level in CACHE_LEVELS if os.path.exists(os.path.join(get_level_folder(level), MANIFEST_FILE_NAME))]
+
+def prune_destination_folder():
+    """Removes anything in DESTINATION_FOLDER that is not a level folder, e.g. the old flat thumbnail layout."""
+    if not os.path.exists(DESTINATION_FOLDER):
+        return
+    level_folder_names = [os.path.basename(get_level_folder(level)) for level in CACHE_LEVELS]
+    for name in os.listdir(DESTINATION_FOLDER):
+        if name in level_folder_names:
+            continue
+        entry_url = os.path.join(DESTINATION_FOLDER, name)
+        if DEBUG: print("Removing unused cache entry:", entry_url)
+        if os.path.isdir(entry_url):
+            shutil.rmtree(entry_url)
+        else:
+            os.remove(entry_url)
+
+def read_cache_level(level):
+    """Loads a level's manifest into image_index and returns (manifest, set of its thumbnail urls)."""
+    level_folder = get_level_folder(level)
+    manifest = load_manifest(level_folder)
+    load_image_index(level_folder, manifest)
+    return manifest, set(os.path.join(level_folder, entry["output"]) for entry in manifest.values())
+
+def switch_cache_level(level, prefetcher, outputs=None):
+    """Points the playlist at another level's thumbnails, keeping its order.
+
+    Pass the outputs from read_cache_level when they were read on another thread, so the
+    render thread only swaps the playlist. Otherwise the level's manifest is read here.
+    """
+    global cache_level, image_folder, current_image_idx
+    level_folder = get_level_folder(level)
+    if outputs is None:
+        outputs = read_cache_level(level)[1]
+
+    switched_paths = []
+    for image_url in images_paths:
+        # Every playlist url starts with image_folder, so swapping the prefix is enough
+        level_image_url = level_folder + image_url[len(image_folder):] if image_folder else image_url
+        if level_image_url in outputs:
+            switched_paths.append(level_image_url)
+    missing_paths = list(outputs - set(switched_paths))
+    random.shuffle(missing_paths)
+    images_paths[:] = switched_paths + group_portraits(missing_paths)
+
+    current_image_idx = min(current_image_idx, max(0, len(images_paths) - 1))
+    cache_level = level
+    image_folder = level_folder
+    # Rescheduling rather than clearing keeps the slides already being prepared when the urls did not
+    # change, as on every warm start, and cancels the rest, so the next transition is still prefetched
+    if images_paths:
+        prefetcher.schedule(images_paths, current_image_idx + len(get_slide_urls(images_paths, current_image_idx)))
+    else:
+        prefetcher.clear()
+
+class CacheLevelBuilder:
+    """Brings one level of the thumbnail cache up to date on a background thread.
+
+    A progressive builder reports each finished thumbnail through the events queue, in the same
+    ("added" | "changed", thumbnail url) form as IngestService, so the slideshow can play the
+    level while it is being built.
+
+    Once the level is built and its manifest read, ready is set and outputs holds its thumbnails.
+    The render thread switches the playlist over with switch_cache_level and sets switched. A
+    progressive builder then evicts the thumbnails of removed photos, which the playlist no longer
+    points at, and done is set when the builder has nothing left to do.
+    """
+    def __init__(self, folder_url, level, progressive=False):
+        self.folder_url = folder_url
+        self.level = level
+        self.progressive = progressive
+        self.events = queue.Queue()
+        self.outputs = None
+        self.ready = threading.Event()
+        self.switched = threading.Event()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="cache-level", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        level_folder = get_level_folder(self.level)
+        # The render thread waits on ready and done, so they are set however the build ends. Otherwise
+        # ingest would never start and no builder would run for a later window size.
+        try:
+            try:
+                resize_all_images(self.folder_url, level_folder, self.level[0], self.level[1],
+                                  on_image_ready=self._image_ready if self.progressive else None, evict_stale=not self.progressive)
+            except Exception as e:
+                # E.g. a crashed resize worker. The level still switches to the thumbnails saved so far.
+                print("Error building cache level:", self.level, e)
+            try:
+                manifest, self.outputs = read_cache_level(self.level)
+            finally:
+                self.ready.set()
+            if self.progressive:
+                self.switched.wait()
+                evict_stale_outputs(level_folder, manifest)
+        except OSError as e:
+            print("Error evicting stale thumbnails:", self.level, e)
+        finally:
+            self.done.set()
+
+    def _image_ready(self, thumbnail_url, entry):
+        event_kind = "changed" if thumbnail_url in image_index else "added"
+        image_index[thumbnail_url] = (entry["width"], entry["height"], entry["orientation"])
+        self.events.put((event_kind, thumbnail_url))
+#endregion CacheLevels
+
+#region Ingest
+class IngestService:
+    """Polls the source folder on a background thread and keeps the thumbnails in sync with it.
+
+    Only directories whose mtime changed are listed again, and in-place edits are caught by
+    re-checking a bounded slice of the known files per poll, so a poll stays cheap on large
+    libraries. Results are handed to the render thread through the events queue as
+    ("added" | "changed" | "removed", thumbnail url) tuples.
+    """
+    def __init__(self, folder_url, destination_folder, width, height):
+        self.folder_url = folder_url
+        self.destination_folder = destination_folder
+        self.width = width
+        self.height = height
+        self.events = queue.Queue()
+        self.manifest = load_manifest(destination_folder)
+        self.dir_mtimes = {}
+        self.dir_files = {}
+        self.dir_children = {} # dir key -> keys of its sub directories, so no lookup has to go through every directory
+        self.pending_jobs = {}
+        self.pending_deletes = []
+        self.stat_cursor = 0
+        self.manifest_changed = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="ingest", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, wait=True):
+        self.stop_event.set()
+        if wait:
+            self.thread.join()
+
+    def _run(self):
+        try:
+            self._scan_directory("")
+            self._remove_unseen_sources()
+        except Exception as e:
+            print("Error scanning image folder:", e)
+        while not self.stop_event.wait(INGEST_POLL_INTERVAL_MS / 1000):
+            try:
+                self.poll()
+            except Exception as e:
+                # Keep polling, the next poll may well succeed
+                print("Error polling image folder:", e)
+
+    def poll(self):
+        self._delete_pending_outputs()
+        for dir_key in list(self.dir_mtimes):
+            if dir_key not in self.dir_mtimes:
+                continue
+            try:
+                dir_mtime = os.stat(os.path.join(self.folder_url, dir_key)).st_mtime_ns
+            except OSError:
+                self._remove_directory(dir_key)
+                continue
+            if dir_mtime != self.dir_mtimes[dir_key]:
+                self._scan_directory(dir_key)
+        self._sweep_known_files()
+        self._process_jobs()
+        if self.manifest_changed:
+            save_manifest(self.destination_folder, self.manifest)
+            self.manifest_changed = False
+
+    def thumbnail_url(self, source_key):
+        return os.path.join(self.destination_folder, self.manifest[source_key]["output"])
+
+    def _scan_directory(self, dir_key):
+        dir_url = os.path.join(self.folder_url, dir_key)
+        # The mtime is read before listing so a file added during the listing triggers another scan
+        self.dir_mtimes[dir_key] = os.stat(dir_url).st_mtime_ns
+        files = set()
+        sub_dirs = set()
+        for entry in os.scandir(dir_url):
+            entry_key = os.path.join(dir_key, entry.name) if dir_key else entry.name
+            if entry.is_dir():
+                sub_dirs.add(entry_key)
+                if entry_key not in self.dir_mtimes:
+                    self._scan_directory(entry_key)
+            elif is_image_file(entry.name):
+                files.add(entry.name)
+                self._check_source(entry_key)
+
+        for file in self.dir_files.get(dir_key, set()) - files:
+            self._remove_source(os.path.join(dir_key, file) if dir_key else file)
+        for sub_dir_key in self.dir_children.get(dir_key, set()) - sub_dirs:
+            self._remove_directory(sub_dir_key)
+        self.dir_children[dir_key] = sub_dirs
+        self.dir_files[dir_key] = files
+
+    def _remove_unseen_sources(self):
+        """Removes manifest entries the startup scan did not find, e.g. photos deleted while the app was not running."""
+        seen_keys = set()
+        for dir_key, files in self.dir_files.items():
+            for file in files:
+                seen_keys.add(os.path.join(dir_key, file) if dir_key else file)
+        for source_key in [key for key in self.manifest if key not in seen_keys]:
+            self._remove_source(source_key)
+
+    def _remove_directory(self, dir_key):
+        for sub_dir_key in self.dir_children.pop(dir_key, set()):
+            self._remove_directory(sub_dir_key)
+        self.dir_children.get(os.path.dirname(dir_key), set()).discard(dir_key)
+        for file in self.dir_files.pop(dir_key, set()):
+            self._remove_source(os.path.join(dir_key, file))
+        self.dir_mtimes.pop(dir_key, None)
+
+    def _check_source(self, source_key):
+        try:
+            entry = build_manifest_entry(os.path.join(self.folder_url, source_key), source_key, self.width, self.height)
+        except FileNotFoundError:
+            self._remove_source(source_key)
+            return
+        except OSError:
+            return
+        if not is_manifest_entry_fresh(self.manifest.get(source_key), entry):
+            self.pending_jobs[source_key] = entry
+
+    def _sweep_known_files(self):
+        source_keys = list(self.manifest)
+        if not source_keys:
+            return
+        if self.stat_cursor >= len(source_keys):
+            self.stat_cursor = 0
+        for source_key in source_keys[self.stat_cursor:self.stat_cursor + INGEST_STAT_BATCH]:
+            self._check_source(source_key)
+        self.stat_cursor += INGEST_STAT_BATCH
+
+    def _remove_source(self, source_key):
+        self.pending_jobs.pop(source_key, None)
+        if source_key not in self.manifest:
+            return
+        thumbnail_url = self.thumbnail_url(source_key)
+        del self.manifest[source_key]
+        self.events.put(("removed", thumbnail_url))
+        # The file goes on the next poll, once the render thread has dropped it from the playlist
+        self.pending_deletes.append(thumbnail_url)
+        self.manifest_changed = True
+
+    def _delete_pending_outputs(self):
+        for thumbnail_url in self.pending_deletes:
+            if os.path.exists(thumbnail_url):
+                os.remove(thumbnail_url)
+            # Folders left empty go as well, up to but not including the level folder
+            dir_url = os.path.dirname(thumbnail_url)
+            while os.path.normpath(dir_url) != os.path.normpath(self.destination_folder) and os.path.isdir(dir_url) and not os.listdir(dir_url):
+                os.rmdir(dir_url)
+                dir_url = os.path.dirname(dir_url)
+        self.pending_deletes = []
+
+    def _process_jobs(self):
+        if not self.pending_jobs:
+            return
+        for source_key in list(self.pending_jobs)[:INGEST_RESIZE_BATCH]:
+            entry = self.pending_jobs.pop(source_key)
+            image_url = os.path.join(self.folder_url, source_key)
+            image_info = resize_image(image_url, os.path.join(self.destination_folder, entry["output"]), self.width, self.height)
+            if not image_info:
+                continue
+            entry.update(image_info)
+            event_kind = "changed" if source_key in self.manifest else "added"
+            self.manifest[source_key] = entry
+            image_index[self.thumbnail_url(source_key)] = (entry["width"], entry["height"], entry["orientation"])
+            self.events.put((event_kind, self.thumbnail_url(source_key)))
+            self.manifest_changed = True
+
+def start_ingest_service(previous_service=None):
+    """(Re)starts ingest into the current cache level; a replaced service finishes its batch on its own."""
+    if previous_service:
+        previous_service.stop(wait=False)
+    if not INGEST_ENABLED:
+        return None
+    ingest_service = IngestService(IMAGE_FOLDER_URL, image_folder, cache_level[0], cache_level[1])
+    ingest_service.start()
+    return ingest_service
+
+def get_ingest_insert_idx(image_url):
+    """Where a new photo joins the playlist: somewhere after the current slide, so it shows up during this pass.
+
+    A portrait joins a later portrait slide that still has room, the way group_portraits would have placed it.
+    Only INGEST_PORTRAIT_PROBES random positions are looked at, so an event costs the same on any playlist.
+    """
+    if not images_paths:
+        return 0
+    first_idx = min(current_image_idx + len(get_slide_urls(images_paths, current_image_idx)), len(images_paths))
+    if is_portrait(image_url) and first_idx < len(images_paths):
+        for _ in range(INGEST_PORTRAIT_PROBES):
+            run_end = random.randint(first_idx, len(images_paths) - 1)
+            if not is_portrait(images_paths[run_end]):
+                continue
+            # A run of portraits plays as slides of MULTI_IMAGE_MAX from its start, so only its last slide can have room
+            run_start = run_end
+            while run_start > first_idx and is_portrait(images_paths[run_start - 1]):
+                run_start -= 1
+            while run_end + 1 < len(images_paths) and is_portrait(images_paths[run_end + 1]):
+                run_end += 1
+            if (run_end + 1 - run_start) % MULTI_IMAGE_MAX:
+                return run_end + 1
+    return random.randint(first_idx, len(images_paths))
+
+def apply_ingest_event(event_kind, image_url, prefetcher):
+    """Splices an ingest result into the live playlist. Must run on the render thread."""
+    global current_image_idx
+    prefetcher.forget(image_url)
+    surface_cache.forget(image_url)
+    if event_kind == "added":
+        if image_url not in images_paths:
+            images_paths.insert(get_ingest_insert_idx(image_url), image_url)
+    elif event_kind == "removed":
+        image_index.pop(image_url, None)
+        if image_url in images_paths:
+            removed_idx = images_paths.index(image_url)
+            images_paths.pop(removed_idx)
+            if removed_idx <= current_image_idx and current_image_idx > 0:
+                current_image_idx -= 1
+
+def apply_ingest_events(events, prefetcher, budget_ms=INGEST_EVENT_BUDGET_MS):
+    """Applies queued events for up to budget_ms, and at least one.
+
+    The rest wait for the next frames, so a poll that found thousands of photos never stalls one frame.
+    """
+    deadline = time.perf_counter() + budget_ms / 1000
+    while True:
+        try:
+            event_kind, image_url = events.get_nowait()
+        except queue.Empty:
+            return
+        apply_ingest_event(event_kind, image_url, prefetcher)
+        if time.perf_counter() >= deadline:
+            return
+
+def drop_unreadable_slide(image_urls, prefetcher):
+    """Takes a slide out of the playlist when its thumbnails can't be loaded, e.g. removed under a level switch.
+
+    Only the missing files are removed when there are any, so the rest of the slide can show up again.
+    """
+    print("Skipping unreadable slide:", image_urls)
+    missing_urls = [image_url for image_url in image_urls if not os.path.exists(image_url)]
+    for image_url in missing_urls or image_urls:
+        apply_ingest_event("removed", image_url, prefetcher)
+#endregion Ingest
+
+#region Scheduler
+class FrameScheduler:
+    """Runs at ACTIVE_FPS while a mosaic animates and drops to IDLE_FPS while the picture is static."""
+    def __init__(self, clock, active_fps=ACTIVE_FPS, idle_fps=IDLE_FPS):
+        self.clock = clock
+        self.active_fps = active_fps
+        self.idle_fps = idle_fps
+        self.needs_full_redraw = True
+
+    def invalidate(self):
+        """Forces the next frame to be drawn in full, e.g. after the window changed."""
+        self.needs_full_redraw = True
+
+    def is_idle(self, mosaics):
+        if self.needs_full_redraw:
+            return False
+        for mosaic in mosaics:
+            if mosaic and mosaic.is_animating():
+                return False
+        return True
+
+    def full_redraw_done(self):
+        self.needs_full_redraw = False
+
+    def tick(self, idle):
+        # A redraw requested after idle was decided, e.g. by a transition starting, wins
+        if self.needs_full_redraw:
+            idle = False
+        return self.clock.tick(self.idle_fps if idle else self.active_fps)
+#endregion Scheduler
+
 class AnimatedMosaic:
-    def __init__(self, mosaic_kind, image_urls=None, animation_type=None, previous_image_info=None):
+    def __init__(self, mosaic_kind, image_urls=None, animation_type=None, previous_image_info=None, prepared_images=None, start_time=None, rng=None):
         self.kind = mosaic_kind
         self.animation_type = animation_type if animation_type else ANIMATION_TYPE_SLIDE_IN
         self.animation_stage = "start"
-        self.stage_start_time = pygame.time.get_ticks()
+        self.stage_start_time = start_time if start_time is not None else pygame.time.get_ticks()
         
         self.current_display_surface = None
         self.rect = pygame.Rect(0, 0, 0, 0)
+        self.source_rect = None # The part of current_display_surface to draw into rect, None for all of it
 
         self.fading_out_surface = None
         self.fading_out_rect = None
+        self.fading_out_source_rect = None
+        self.scratch_slot = scratch_surfaces.acquire_slot()
 
-        if self.kind == MOSAIC_KIND_SINGLE_IMAGE:
+        # A multi-image mosaic is composited into one surface up front and from then on animates
+        # exactly like a single image, at the same per-frame cost
+        if self.kind in (MOSAIC_KIND_SINGLE_IMAGE, MOSAIC_KIND_MULTI_IMAGE):
+            self.image_urls = list(image_urls)
             self.image_url = image_urls[0]
-            self.original_image = pygame.image.load(self.image_url).convert_alpha()
-            self.orientation = get_orientation(self.image_url)
-
-            if self.orientation == 3:
-                self.original_image = pygame.transform.rotate(self.original_image, 180)
-            elif self.orientation == 6:
-                self.original_image = pygame.transform.rotate(self.original_image, -90)
-            elif self.orientation == 8:
-                self.original_image = pygame.transform.rotate(self.original_image, 90)
-
-            self.original_width = self.original_image.get_width()
-            self.original_height = self.original_image.get_height()
-
-            if self.original_width > WINDOW_WIDTH or self.original_height > WINDOW_HEIGHT:
-                if self.original_width > self.original_height:
-                    scale_factor_r = WINDOW_WIDTH / self.original_width
-                else:
-                    scale_factor_r = WINDOW_HEIGHT / self.original_height
-                self.original_width = int(self.original_width * scale_factor_r)
-                self.original_height = int(self.original_height * scale_factor_r)
+            # Surfaces decoded ahead of time by the ImagePrefetcher, or still in the surface cache
+            # from an earlier pass through the playlist, skip the disk entirely
+            with profiler.section("load"):
+                image_key = get_slide_cache_key(self.image_urls)
+                self.original_image = surface_cache.get(image_key)
+                if self.original_image is None:
+                    prepared_image = prepared_images[0] if prepared_images else prepare_slide(self.image_urls)
+                    self.original_image = convert_for_display(prepared_image)
+                    surface_cache.put(image_key, self.original_image)
+
+            self.original_width, self.original_height = get_display_size(self.original_image.get_width(), self.original_image.get_height())
+            self._prepare_base_surface()
 
             if previous_image_info:
                 self.previous_image_url = previous_image_info[2]
-                self.previous_image_surface = pygame.image.load(self.previous_image_url).convert_alpha()
                 self.original_previous_width = previous_image_info[0]
                 self.original_previous_height = previous_image_info[1]
+                # The finished mosaic hands over its display-size surface, so nothing is read from disk here
+                if len(previous_image_info) > 3 and previous_image_info[3]:
+                    self.previous_image_surface = previous_image_info[3]
+                else:
+                    with profiler.section("load"):
+                        self.previous_image_surface = convert_for_display(prepare_image(self.previous_image_url))
+                previous_size = (self.original_previous_width, self.original_previous_height)
+                if self.previous_image_surface.get_size() != previous_size:
+                    with profiler.section("scale"):
+                        self.previous_image_surface = pygame.transform.smoothscale(self.previous_image_surface, previous_size)
 
             if self.animation_type == ANIMATION_TYPE_FLIP:
                 self.animation_stage = "flip_out_current"
                 self.current_display_image_ref = self.previous_image_surface
-                self.target_width_for_flip = self.original_previous_width 
+                self.target_width_for_flip = self.original_previous_width
                 self.target_height_for_flip = self.original_previous_height
                 self._update_transform_for_flip()
             elif self.animation_type == ANIMATION_TYPE_CROSSFADE:
@@ -186,7 +1399,8 @@ class AnimatedMosaic:
                 
                 center_x_offset = (WINDOW_WIDTH - self.original_width) / 2 if self.original_width < WINDOW_WIDTH else 0
                 
-                self.slide_direction = random.choice(['left', 'right'])
+                # An export passes its own seeded rng so the same slide always comes in from the same side
+                self.slide_direction = (rng or random).choice(['left', 'right'])
                 if self.slide_direction == 'left':
                     self.current_x = -WINDOW_WIDTH + center_x_offset
                 else:
@@ -194,32 +1408,95 @@ class AnimatedMosaic:
 
                 self._update_single_image_transform()
 
-        elif self.kind == MOSAIC_KIND_MULTI_IMAGE:
-            # to do: image mosaic stuff
-            pass
 
-    def set_fading_out_visuals(self, surface, rect):
+    def is_animating(self):
+        return self.animation_stage != "complete"
+
+    def set_fading_out_visuals(self, surface, rect, source_rect=None):
         self.fading_out_surface = surface
         self.fading_out_rect = rect
+        self.fading_out_source_rect = source_rect
+
+    def _prepare_base_surface(self):
+        # Rendered once per slide; every frame of the zoom is cropped out of this surface
+        if (self.original_image.get_width(), self.original_image.get_height()) == (self.original_width, self.original_height):
+            self.base_surface = self.original_image
+            return
+        base_key = get_slide_cache_key(self.image_urls, (self.original_width, self.original_height))
+        self.base_surface = surface_cache.get(base_key)
+        if self.base_surface is None:
+            with profiler.section("scale"):
+                self.base_surface = pygame.transform.smoothscale(self.original_image, (self.original_width, self.original_height))
+            surface_cache.put(base_key, self.base_surface)
 
     def _update_single_image_transform(self):
         display_width = max(1, int(self.original_width * self.current_scale))
         display_height = max(1, int(self.original_height * self.current_scale))
-        self.current_display_surface = pygame.transform.smoothscale(self.original_image, (display_width, display_height))
-        self.rect = self.current_display_surface.get_rect(topleft=(self.current_x, self.current_y))
+        target_rect = pygame.Rect(0, 0, display_width, display_height)
+        target_rect.topleft = (self.current_x, self.current_y)
+
+        self.source_rect = None
+        if (display_width, display_height) == (self.original_width, self.original_height):
+            self.current_display_surface = self.base_surface
+            self.rect = target_rect
+            return
+
+        # Only the part of the zoomed image that lands on screen gets resampled, so the cost
+        # of a frame depends on the window size and not on the size of the photo
+        visible_rect = target_rect.clip(pygame.Rect(0, 0, WINDOW_WIDTH, WINDOW_HEIGHT))
+        if visible_rect.width == 0 or visible_rect.height == 0:
+            self.current_display_surface = self.base_surface
+            self.rect = target_rect
+            return
+
+        # smoothscale only ever enlarges here: shrinking by a ratio just under 1 darkens the output
+        ratio_x = self.original_width / display_width
+        ratio_y = self.original_height / display_height
+        source_left = int(round((visible_rect.x - target_rect.x) * ratio_x))
+        source_top = int(round((visible_rect.y - target_rect.y) * ratio_y))
+        source_right = min(self.base_surface.get_width(), int(round((visible_rect.right - target_rect.x) * ratio_x)))
+        source_bottom = min(self.base_surface.get_height(), int(round((visible_rect.bottom - target_rect.y) * ratio_y)))
+        source_rect = pygame.Rect(source_left, source_top, max(1, source_right - source_left), max(1, source_bottom - source_top))
+        source_rect = source_rect.clip(self.base_surface.get_rect())
+
+        if texture_renderer:
+            # The renderer stretches the crop into rect while drawing, nothing is resampled here
+            self.current_display_surface = self.base_surface
+            self.source_rect = source_rect
+        else:
+            with profiler.section("scale"):
+                source = self.base_surface.subsurface(source_rect)
+                destination = scratch_surfaces.get(self.scratch_slot, self.base_surface, visible_rect.size)
+                if source_rect.width != visible_rect.width and source_rect.height != visible_rect.height:
+                    # Scaling both axes at once makes smoothscale allocate a temporary buffer every frame.
+                    # One axis at a time through a second scratch surface gives the same pixels without it.
+                    stretched = scratch_surfaces.get(self.scratch_slot, self.base_surface, (visible_rect.width, source_rect.height), 1)
+                    source = pygame.transform.smoothscale(source, stretched.get_size(), stretched)
+                self.current_display_surface = pygame.transform.smoothscale(source, visible_rect.size, destination)
+        self.rect = visible_rect
 
     def _update_transform_for_flip(self):
         display_width = max(1, int(self.target_width_for_flip))
         display_height = max(1, int(self.target_height_for_flip))
-        
-        self.current_display_surface = pygame.transform.smoothscale(self.current_display_image_ref, (display_width, display_height))
-        self.rect = self.current_display_surface.get_rect(center=(WINDOW_WIDTH / 2, WINDOW_HEIGHT / 2))
+
+        # Both flip sources are already at display size, so each frame only has to drop rows.
+        # A nearest-neighbour scale does that in one pass over the output rows instead of
+        # filtering the whole image like smoothscale would.
+        self.source_rect = None
+        if self.current_display_image_ref.get_size() == (display_width, display_height) or texture_renderer:
+            self.current_display_surface = self.current_display_image_ref
+        else:
+            with profiler.section("scale"):
+                destination = scratch_surfaces.get(self.scratch_slot, self.current_display_image_ref, (display_width, display_height))
+                self.current_display_surface = pygame.transform.scale(self.current_display_image_ref, (display_width, display_height), destination)
+        self.rect = pygame.Rect(0, 0, display_width, display_height)
+        self.rect.center = (WINDOW_WIDTH / 2, WINDOW_HEIGHT / 2)
 
 
     def update(self, current_time):
         elapsed_in_stage = current_time - self.stage_start_time
 
-        if self.kind == MOSAIC_KIND_SINGLE_IMAGE:
+        if self.kind in (MOSAIC_KIND_SINGLE_IMAGE, MOSAIC_KIND_MULTI_IMAGE):
             if self.animation_type == ANIMATION_TYPE_SLIDE_IN:
                 # Stage 1: Slide In
                 if self.animation_stage == "slide":
@@ -291,7 +1568,7 @@ class AnimatedMosaic:
                     if self.target_height_for_flip < 1:
                         self.target_height_for_flip = 1
                     
-                    self.current_display_image_ref = self.original_image
+                    self.current_display_image_ref = self.base_surface
                     self.target_width_for_flip = self.original_width
                     self._update_transform_for_flip()
 
@@ -360,126 +1637,262 @@ class AnimatedMosaic:
                         self._update_single_image_transform()
 
 
-        elif self.kind == MOSAIC_KIND_MULTI_IMAGE:
-            # Multi-image update logic goes here
-            pass
-
     def draw(self, surface):
         """Draws the current display surface of the mosaic to the given surface."""
-        # NEW: Custom drawing for cross-fade animation
-        if self.animation_type == ANIMATION_TYPE_CROSSFADE and self.animation_stage == "crossfade":
-            # Draw the fading out previous image at its *last known rendered size/position*
-            # This uses the surface and rect passed via set_fading_out_visuals
-            if self.fading_out_surface:
-                self.fading_out_surface.set_alpha(255 - self.current_alpha) # Fades from 255 to 0
-                surface.blit(self.fading_out_surface, self.fading_out_rect.topleft)
-
-            # Draw the fading in new image at its *original size, centered*
-            new_image_x = (WINDOW_WIDTH - self.original_width) / 2
-            new_image_y = (WINDOW_HEIGHT - self.original_height) / 2
+        with profiler.section("blit"):
+            # NEW: Custom drawing for cross-fade animation
+            if self.animation_type == ANIMATION_TYPE_CROSSFADE and self.animation_stage == "crossfade":
+                # Draw the fading out previous image at its *last known rendered size/position*
+                # This uses the surface and rect passed via set_fading_out_visuals
+                if self.fading_out_surface:
+                    previous_alpha = self.fading_out_surface.get_alpha()
+                    self.fading_out_surface.set_alpha(255 - self.current_alpha) # Fades from 255 to 0
+                    surface.blit(self.fading_out_surface, self.fading_out_rect, self.fading_out_source_rect)
+                    self.fading_out_surface.set_alpha(previous_alpha)
+
+                # Draw the fading in new image at its *original size, centered*
+                new_image_x = (WINDOW_WIDTH - self.original_width) / 2
+                new_image_y = (WINDOW_HEIGHT - self.original_height) / 2
             
-            # The original_image is already at its original dimensions
-            self.original_image.set_alpha(self.current_alpha) # Fades from 0 to 255
-            surface.blit(self.original_image, (new_image_x, new_image_y))
-        else:
-            # Normal drawing for slide-in, flip, or scale_up phases
-            if self.current_display_surface:
-                surface.blit(self.current_display_surface, self.rect)
-
-resize_all_images(IMAGE_FOLDER_URL, DESTINATION_FOLDER, WINDOW_WIDTH, WINDOW_HEIGHT)
-
-load_images(DESTINATION_FOLDER)
-current_image_idx = 0
-# Initialize the first mosaic
-current_display_mosaic = AnimatedMosaic(MOSAIC_KIND_SINGLE_IMAGE, [images_paths[current_image_idx]], animation_type=ANIMATION_TYPE_SLIDE_IN)
-next_image_trigger_time = pygame.time.get_ticks() + SLIDE_DURATION_MS + SCALE_DURATION_MS + 1
-
-while running:
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-        if event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_ESCAPE:
-                running = False
-        if event.type == pygame.VIDEORESIZE:
-            WINDOW_WIDTH, WINDOW_HEIGHT = event.size
-            screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), pygame.RESIZABLE)
-            
-            if current_display_mosaic:
-                current_display_mosaic = AnimatedMosaic(MOSAIC_KIND_SINGLE_IMAGE, [current_display_mosaic.image_url], animation_type=ANIMATION_TYPE_SLIDE_IN)
-            
-            background_mosaic = None
-            
-            next_image_trigger_time = pygame.time.get_ticks() + SLIDE_DURATION_MS + SCALE_DURATION_MS + 1
-
-
-    screen.fill((0, 0, 0))
-
-    current_time_ms = pygame.time.get_ticks()
-
-    if background_mosaic and current_display_mosaic.animation_type == ANIMATION_TYPE_SLIDE_IN:
-        background_mosaic.update(current_time_ms)
-        background_mosaic.draw(screen)
-
-    if current_display_mosaic:
-        current_display_mosaic.update(current_time_ms)
-        current_display_mosaic.draw(screen)
-    
-        if current_display_mosaic.animation_stage == "complete" and current_time_ms >= next_image_trigger_time:
-            
-            temp_finished_mosaic = current_display_mosaic 
-
-            current_image_idx = (current_image_idx + 1) % len(images_paths)
-            next_image_url = images_paths[current_image_idx]
-
-            temp_next_image_for_check = pygame.image.load(next_image_url)
-            next_image_width = temp_next_image_for_check.get_width()
-            next_image_height = temp_next_image_for_check.get_height()
-            del temp_next_image_for_check
-
-            can_be_transition_animation = False
-            if (temp_finished_mosaic.kind == MOSAIC_KIND_SINGLE_IMAGE and 
-                temp_finished_mosaic.original_width == next_image_width and 
-                temp_finished_mosaic.original_height == next_image_height):
-                can_be_transition_animation = True
-            
-            new_animation_type = ANIMATION_TYPE_SLIDE_IN
-            if can_be_transition_animation:
-                new_animation_type = random.choice([ANIMATION_TYPE_FLIP, ANIMATION_TYPE_CROSSFADE])
-            
-            if new_animation_type == ANIMATION_TYPE_FLIP or new_animation_type == ANIMATION_TYPE_CROSSFADE:
-                background_mosaic = None 
+                # base_surface is the image at its display size and, for opaque photos, in the display's
+                # own opaque format, so SDL can use its fast surface-alpha blit for both layers
+                previous_alpha = self.base_surface.get_alpha()
+                self.base_surface.set_alpha(self.current_alpha) # Fades from 0 to 255
+                surface.blit(self.base_surface, (new_image_x, new_image_y))
+                # Both surfaces can be shared through the surface cache, so each gets back the alpha it had.
+                # set_alpha(None) would also switch off per-pixel alpha blending on SRCALPHA surfaces.
+                self.base_surface.set_alpha(previous_alpha)
             else:
-                background_mosaic = temp_finished_mosaic
-
-            if new_animation_type == ANIMATION_TYPE_FLIP:
-                previous_image_info = (temp_finished_mosaic.original_width, 
-                                       temp_finished_mosaic.original_height,
-                                       temp_finished_mosaic.image_url)
-                current_display_mosaic = AnimatedMosaic(MOSAIC_KIND_SINGLE_IMAGE, [next_image_url], animation_type=ANIMATION_TYPE_FLIP, previous_image_info=previous_image_info)
-                next_image_trigger_time = current_time_ms + FLIP_DURATION_MS + SCALE_DURATION_MS + 1 
-            elif new_animation_type == ANIMATION_TYPE_CROSSFADE:
-                previous_image_info = (temp_finished_mosaic.original_width, 
-                                       temp_finished_mosaic.original_height,
-                                       temp_finished_mosaic.image_url)
-                current_display_mosaic = AnimatedMosaic(MOSAIC_KIND_SINGLE_IMAGE, [next_image_url], animation_type=ANIMATION_TYPE_CROSSFADE, previous_image_info=previous_image_info)
-                # NEW: Pass the previous image's final rendered state to the new mosaic
-                current_display_mosaic.set_fading_out_visuals(temp_finished_mosaic.current_display_surface,
-                                                               temp_finished_mosaic.rect)
-                next_image_trigger_time = current_time_ms + CROSSFADE_DURATION_MS + SCALE_DURATION_MS + 1
+                # Normal drawing for slide-in, flip, or scale_up phases
+                if self.current_display_surface:
+                    surface.blit(self.current_display_surface, self.rect, self.source_rect)
+
+#region Transitions
+def choose_animation_type(previous_size, next_size, rng=None):
+    """Flip and crossfade only work between slides of the same display size, anything else slides in."""
+    if previous_size == next_size:
+        return (rng or random).choice([ANIMATION_TYPE_FLIP, ANIMATION_TYPE_CROSSFADE])
+    return ANIMATION_TYPE_SLIDE_IN
+
+def get_transition_delay_ms(animation_type):
+    """How long a slide stays up, from the start of its transition to the start of the next one."""
+    transition_durations = {
+        ANIMATION_TYPE_SLIDE_IN: SLIDE_DURATION_MS,
+        ANIMATION_TYPE_FLIP: FLIP_DURATION_MS,
+        ANIMATION_TYPE_CROSSFADE: CROSSFADE_DURATION_MS,
+    }
+    return transition_durations[animation_type] + SCALE_DURATION_MS + HOLD_DURATION_MS + 1
+
+def start_transition(finished_mosaic, image_urls, animation_type, prepared_image=None, start_time=None, rng=None):
+    """Builds the mosaic that takes over from finished_mosaic with the given animation."""
+    previous_image_info = None
+    if animation_type in (ANIMATION_TYPE_FLIP, ANIMATION_TYPE_CROSSFADE):
+        previous_image_info = (finished_mosaic.original_width,
+                               finished_mosaic.original_height,
+                               finished_mosaic.image_url,
+                               finished_mosaic.base_surface)
+    mosaic = AnimatedMosaic(get_mosaic_kind(image_urls), image_urls, animation_type=animation_type, previous_image_info=previous_image_info,
+                            prepared_images=[prepared_image] if prepared_image is not None else None, start_time=start_time, rng=rng)
+    if animation_type == ANIMATION_TYPE_CROSSFADE:
+        # The previous image fades out from its final rendered state
+        mosaic.set_fading_out_visuals(finished_mosaic.current_display_surface, finished_mosaic.rect, finished_mosaic.source_rect)
+    return mosaic
+#endregion Transitions
+
+if __name__ == "__main__":
+    startup_time = time.perf_counter()
+    pygame.init()
+    if RENDER_BACKEND == RENDER_BACKEND_TEXTURE:
+        texture_renderer = create_texture_renderer((WINDOW_WIDTH, WINDOW_HEIGHT))
+    if texture_renderer:
+        screen = texture_renderer
+    else:
+        #screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), pygame.RESIZABLE)
+        screen = pygame.display.set_mode((0 ,0), pygame.FULLSCREEN)
+    WINDOW_WIDTH, WINDOW_HEIGHT = screen.get_size()
+    clock = pygame.time.Clock()
+    font_small = pygame.freetype.Font(FONT_URL, FONT_SIZE_SM)
+    font = pygame.freetype.Font(FONT_URL, FONT_SIZE)
+    font_xlarge = pygame.freetype.Font(FONT_URL, FONT_SIZE_XLARGE)
+    font_debug = pygame.freetype.Font(FONT_URL, FONT_SIZE_DEBUG) if profiler.enabled else None
+    hud = Hud(font_small, font, font_xlarge, font_debug)
+    scheduler = FrameScheduler(clock)
+
+    prune_destination_folder()
+    cache_level = get_cache_level(WINDOW_WIDTH, WINDOW_HEIGHT)
+    image_folder = get_level_folder(cache_level)
+
+    # Play whatever thumbnails the last run left behind right away, and let the rest of the
+    # folder resize in the background, joining the rotation as each image is done
+    # The index goes first, load_images needs it to pair up portraits without opening every file
+    load_image_index(image_folder)
+    load_images(image_folder)
+    current_image_idx = 0
+    prefetcher = ImagePrefetcher()
+    level_builder = CacheLevelBuilder(IMAGE_FOLDER_URL, cache_level, progressive=True).start()
+    # Ingest starts once the startup resize is done, so the two never resize the same photo
+    ingest_service = None
+    next_image_trigger_time = 0
+    first_frame_ms = None
+
+    while running:
+        profiler.begin_frame()
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    running = False
+            if event.type == pygame.VIDEORESIZE:
+                WINDOW_WIDTH, WINDOW_HEIGHT = event.size
+                if texture_renderer is None:
+                    screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), pygame.RESIZABLE)
+                # Slides prepared for the old size are dropped; multi-image slides are composited at window size
+                prefetcher.clear()
+                scratch_surfaces.clear()
+
+                # Switch straight to the closest level already on disk, and bring the level that
+                # fits this size up to date in the background
+                wanted_level = get_cache_level(WINDOW_WIDTH, WINDOW_HEIGHT)
+                if wanted_level != cache_level:
+                    closest_level = get_cache_level(WINDOW_WIDTH, WINDOW_HEIGHT, get_available_cache_levels() or [cache_level])
+                    if closest_level != cache_level:
+                        switch_cache_level(closest_level, prefetcher)
+                        ingest_service = start_ingest_service(ingest_service)
+                    # Only when the level that fits is not on disk yet, otherwise it was just switched to
+                    if closest_level != wanted_level and level_builder is None:
+                        level_builder = CacheLevelBuilder(IMAGE_FOLDER_URL, wanted_level).start()
+
+                if current_display_mosaic:
+                    try:
+                        current_display_mosaic = AnimatedMosaic(current_display_mosaic.kind, current_display_mosaic.image_urls, animation_type=ANIMATION_TYPE_SLIDE_IN)
+                    except (pygame.error, OSError):
+                        drop_unreadable_slide(current_display_mosaic.image_urls, prefetcher)
+                        current_display_mosaic = None # The first slide code below picks up from current_image_idx
+
+                background_mosaic = None
+                scheduler.invalidate()
+
+                next_image_trigger_time = pygame.time.get_ticks() + get_transition_delay_ms(ANIMATION_TYPE_SLIDE_IN)
+
+
+        if level_builder and level_builder.level == cache_level:
+            apply_ingest_events(level_builder.events, prefetcher)
+
+        # The builder reads the manifest and evicts on its own thread, only the playlist swap happens here
+        # Events still queued would be lost once the builder is dropped, so they are applied first
+        if level_builder and level_builder.ready.is_set() and level_builder.events.empty() and not level_builder.switched.is_set():
+            switch_cache_level(level_builder.level, prefetcher, level_builder.outputs)
+            level_builder.switched.set()
+
+        if level_builder and level_builder.switched.is_set() and level_builder.done.is_set():
+            ingest_service = start_ingest_service(ingest_service)
+            wanted_level = get_cache_level(WINDOW_WIDTH, WINDOW_HEIGHT)
+            level_builder = None
+            if wanted_level != cache_level:
+                level_builder = CacheLevelBuilder(IMAGE_FOLDER_URL, wanted_level).start()
+
+        if ingest_service:
+            apply_ingest_events(ingest_service.events, prefetcher)
+
+        current_time_ms = pygame.time.get_ticks()
+
+        # The first slide starts as soon as there is an image, which may be a while on the very first run
+        if current_display_mosaic is None and images_paths:
+            current_image_idx = min(current_image_idx, len(images_paths) - 1)
+            first_image_urls = get_slide_urls(images_paths, current_image_idx)
+            try:
+                with profiler.section("load"):
+                    current_display_mosaic = AnimatedMosaic(get_mosaic_kind(first_image_urls), first_image_urls, animation_type=ANIMATION_TYPE_SLIDE_IN)
+            except (pygame.error, OSError):
+                drop_unreadable_slide(first_image_urls, prefetcher)
             else:
-                current_display_mosaic = AnimatedMosaic(MOSAIC_KIND_SINGLE_IMAGE, [next_image_url], animation_type=ANIMATION_TYPE_SLIDE_IN)
-                next_image_trigger_time = current_time_ms + SLIDE_DURATION_MS + SCALE_DURATION_MS + 1
-
-
-    print_date()
-    print_time()
-
-    actual_fps = clock.get_fps()
-    fps_text_surface, fps_rect = font_small.render(f"FPS: {int(actual_fps)}", TEXT_COLOR)
-    screen.blit(fps_text_surface, (TEXT_PADDING, TEXT_PADDING))
-
-    pygame.display.flip()
-    clock.tick(120)
-
-pygame.quit()
+                prefetcher.schedule(images_paths, current_image_idx + len(first_image_urls))
+                next_image_trigger_time = current_time_ms + get_transition_delay_ms(ANIMATION_TYPE_SLIDE_IN)
+                scheduler.invalidate()
+
+        visible_mosaics = [current_display_mosaic]
+        if background_mosaic and current_display_mosaic.animation_type == ANIMATION_TYPE_SLIDE_IN:
+            visible_mosaics.insert(0, background_mosaic)
+
+        idle = scheduler.is_idle(visible_mosaics)
+        if idle:
+            stage_key = "idle"
+        elif current_display_mosaic:
+            stage_key = current_display_mosaic.animation_type + "/" + current_display_mosaic.animation_stage
+        else:
+            stage_key = "waiting"
+        hud_dirty_rects = hud.update(clock, current_time_ms, stage_key)
+
+        if idle:
+            # Nothing moves, so only the HUD areas whose text changed are repainted and pushed to the display.
+            # The texture renderer always presents a whole frame, so it redraws everything once instead.
+            if hud_dirty_rects:
+                for dirty_rect in (hud_dirty_rects if texture_renderer is None else [None]):
+                    screen.set_clip(dirty_rect)
+                    screen.fill((0, 0, 0))
+                    for mosaic in visible_mosaics:
+                        if mosaic:
+                            mosaic.draw(screen)
+                screen.set_clip(None)
+                with profiler.section("blit"):
+                    hud.draw(screen)
+                with profiler.section("present"):
+                    present_display(hud_dirty_rects)
+        else:
+            screen.fill((0, 0, 0))
+            for mosaic in visible_mosaics:
+                if mosaic:
+                    mosaic.update(current_time_ms)
+                    mosaic.draw(screen)
+            with profiler.section("blit"):
+                hud.draw(screen)
+            with profiler.section("present"):
+                present_display()
+            scheduler.full_redraw_done()
+            if first_frame_ms is None and current_display_mosaic:
+                first_frame_ms = (time.perf_counter() - startup_time) * 1000
+                profiler.record_first_frame(first_frame_ms)
+
+        if current_display_mosaic:
+            if current_display_mosaic.animation_stage == "complete" and current_time_ms >= next_image_trigger_time and images_paths:
+
+                temp_finished_mosaic = current_display_mosaic 
+
+                finished_image_idx = current_image_idx
+                current_image_idx = (current_image_idx + len(temp_finished_mosaic.image_urls)) % len(images_paths)
+                next_image_urls = get_slide_urls(images_paths, current_image_idx)
+
+                try:
+                    with profiler.section("load"):
+                        next_prepared_image = prefetcher.get(next_image_urls)
+                except (pygame.error, OSError):
+                    # The finished slide stays up and the next frame tries the slide after it
+                    current_image_idx = finished_image_idx
+                    drop_unreadable_slide(next_image_urls, prefetcher)
+                else:
+                    prefetcher.schedule(images_paths, current_image_idx + len(next_image_urls))
+
+                    new_animation_type = choose_animation_type((temp_finished_mosaic.original_width, temp_finished_mosaic.original_height),
+                                                               get_slide_display_size(next_image_urls))
+
+                    # Only a slide-in leaves the previous image visible behind the new one
+                    if new_animation_type == ANIMATION_TYPE_SLIDE_IN:
+                        background_mosaic = temp_finished_mosaic
+                    else:
+                        background_mosaic = None
+
+                    current_display_mosaic = start_transition(temp_finished_mosaic, next_image_urls, new_animation_type, next_prepared_image)
+                    next_image_trigger_time = current_time_ms + get_transition_delay_ms(new_animation_type)
+                    # The new slide starts animating now, the rest of this frame must not sleep at IDLE_FPS
+                    scheduler.invalidate()
+
+        profiler.end_frame(stage_key, idle)
+        profiler.dump(PROFILE_DUMP_URL, current_time_ms)
+        scheduler.tick(idle)
+
+    profiler.dump(PROFILE_DUMP_URL)
+    if ingest_service:
+        ingest_service.stop()
+    prefetcher.shutdown()
+    pygame.quit()